@@ -0,0 +1,96 @@
+"""Offline broadcast throughput benchmark.
+
+Runs the real broadcast engine against a throwaway database and a fake bot
+that simulates Telegram's API latency, blocked users and flood control.
+Sends go through the bot's ApiRateLimiter, so ``--rate`` plays the part of
+API_RATE_LIMIT and broadcasts get its bulk share.
+
+    python benchmarks/broadcast_bench.py --users 5000 --rate 1000
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.error import Forbidden, RetryAfter  # noqa: E402
+
+import broadcast  # noqa: E402
+import database  # noqa: E402
+import ratelimit  # noqa: E402
+
+
+class FakeBot:
+    """Stand-in for telegram.ext.ExtBot that only implements send_message."""
+
+    def __init__(self, limiter, latency, blocked_ratio=0.0, flood_every=0):
+        self.limiter = limiter
+        self.latency = latency
+        self.blocked_ratio = blocked_ratio
+        self.flood_every = flood_every
+        self.calls = 0
+        self.delivered = 0
+
+    async def send_message(self, chat_id, text, rate_limit_args=None, **kwargs):
+        await self.limiter.process_request(
+            self._deliver, (), {}, "sendMessage", {"chat_id": chat_id, "text": text}, rate_limit_args
+        )
+
+    async def _deliver(self):
+        self.calls += 1
+        call = self.calls
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if self.flood_every and call % self.flood_every == 0:
+            raise RetryAfter(1)
+        if random.random() < self.blocked_ratio:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        self.delivered += 1
+
+
+async def run(args):
+    database.init_db()
+    conn = database.get_connection()
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id, full_name) VALUES (?, ?)",
+            ((uid, f"user {uid}") for uid in range(1, args.users + 1)),
+        )
+    job_id = database.create_broadcast_job("benchmark")
+    limiter = ratelimit.ApiRateLimiter(rate=args.rate)
+    bot = FakeBot(limiter, args.latency / 1000, args.blocked, args.flood_every)
+
+    started = time.perf_counter()
+    await broadcast.run_job(bot, job_id, "benchmark", concurrency=args.concurrency, batch_size=args.batch_size)
+    elapsed = time.perf_counter() - started
+
+    job = database.get_broadcast_job(job_id)
+    print(f"users={args.users} rate={args.rate}/s bulk_rate={limiter.bulk_bucket.rate:g}/s concurrency={args.concurrency} latency={args.latency}ms")
+    print(f"sent={job[4]} failed={job[5]} api_calls={bot.calls}")
+    print(f"elapsed={elapsed:.2f}s throughput={args.users / elapsed:.1f} msg/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=30, help="API_RATE_LIMIT, messages per second")
+    parser.add_argument("--concurrency", type=int, default=broadcast.CONCURRENCY)
+    parser.add_argument("--batch-size", type=int, default=broadcast.BATCH_SIZE)
+    parser.add_argument("--latency", type=float, default=150, help="mean API latency in ms")
+    parser.add_argument("--blocked", type=float, default=0.02, help="share of users who blocked the bot")
+    parser.add_argument("--flood-every", type=int, default=0, help="raise RetryAfter every N calls")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, "bench.db")
+        try:
+            asyncio.run(run(args))
+        finally:
+            database.close_all()
+
+
+if __name__ == "__main__":
+    main()
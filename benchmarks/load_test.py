@@ -0,0 +1,340 @@
+"""End-to-end load test against a local stand-in for the Telegram Bot API.
+
+Seeds a throwaway database, then drives the real Application (every handler,
+the ConversationHandler and persistence included) with a synthetic mix of
+/start, /browse, subject and note taps, /search, inline searches typed one keystroke at a time and complete uploads. The
+bot talks to a fake Bot API served from this process, which answers after a
+configurable latency. Updates reach the bot either by long polling
+(getUpdates on the fake API) or by POSTing them to the real webhook server.
+
+    python benchmarks/load_test.py --mode webhook --notes 100000 --updates 5000 --rate 200
+    python benchmarks/load_test.py --mode polling --notes 1000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tornado.httpclient  # noqa: E402
+import tornado.web  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+
+import database  # noqa: E402
+
+_tmp = tempfile.TemporaryDirectory()
+database.DB_NAME = os.path.join(_tmp.name, "bench.db")
+# Synthetic users send bursts that flood protection would drop, and dropped
+# updates never complete; read when bot is imported.
+os.environ.setdefault("USER_RATE_LIMIT", "1e6")
+os.environ.setdefault("USER_BURST", "1000000")
+
+import bot  # noqa: E402
+import webhook  # noqa: E402
+
+TOKEN = "123456:BENCHMARK"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+WORDS = [
+    "cell", "photosynthesis", "enzyme", "genetics", "ecology", "organic", "acids",
+    "bonding", "kinetics", "optics", "waves", "circuits", "calculus", "vectors",
+    "matrices", "statistics", "soil", "crops", "livestock", "irrigation",
+]
+
+# Relative weight of each user action; an upload is four updates and an
+# inline search one update per keystroke.
+MIX = {"start": 10, "browse": 15, "subject": 20, "search": 20, "note": 25, "upload": 10, "inline": 5}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def seed(notes):
+    """Insert ``notes`` notes with titles drawn from WORDS, one second apart."""
+    conn = database.get_connection()
+    with conn:
+        conn.executemany(
+            "INSERT INTO notes (file_id, file_unique_id, file_name, title, subject, user_id, user_name, upload_date)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now', ?))",
+            (
+                (f"file{i}", f"seed{i}", f"note{i}.pdf",
+                 " ".join(random.sample(WORDS, 3)), random.choice(bot.ALLOWED_SUBJECTS),
+                 i % 1000, f"User{i % 1000}", f"-{i} seconds")
+                for i in range(notes)
+            ),
+        )
+
+
+# --- Synthetic updates ---
+
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"User{uid}"}
+
+
+def _chat(uid):
+    return {"id": uid, "type": "private", "first_name": f"User{uid}"}
+
+
+def _message(update_id, uid, **fields):
+    text = fields.get("text", "")
+    if text.startswith("/"):
+        fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": int(time.time()), "chat": _chat(uid), "from": _user(uid), **fields},
+    }
+
+
+def _callback(update_id, uid, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(uid),
+            "chat_instance": str(uid),
+            "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": _chat(uid), "from": BOT_USER, "text": "-"},
+        },
+    }
+
+
+def _inline_query(update_id, uid, query):
+    return {
+        "update_id": update_id,
+        "inline_query": {"id": str(update_id), "from": _user(uid), "query": query, "offset": ""},
+    }
+
+
+def make_updates(count, users, notes):
+    updates = []
+    actions = list(MIX)
+    weights = list(MIX.values())
+    while len(updates) < count:
+        uid = random.randint(1, users)
+        action = random.choices(actions, weights)[0]
+        next_id = len(updates) + 1
+        if action == "start":
+            updates.append(_message(next_id, uid, text="/start"))
+        elif action == "browse":
+            updates.append(_message(next_id, uid, text="/browse"))
+        elif action == "subject":
+            updates.append(_callback(next_id, uid, f"sub_{random.choice(bot.ALLOWED_SUBJECTS)}"))
+        elif action == "search":
+            updates.append(_message(next_id, uid, text=f"/search {random.choice(WORDS)}"))
+        elif action == "inline":
+            word = random.choice(WORDS)
+            for length in range(1, len(word) + 1):
+                updates.append(_inline_query(len(updates) + 1, uid, word[:length]))
+        elif action == "note":
+            updates.append(_callback(next_id, uid, f"note_{random.randint(1, max(notes, 1))}"))
+        else:
+            document = {"file_id": f"upload{next_id}", "file_unique_id": f"upload{next_id}", "file_name": "new.pdf"}
+            updates.append(_message(next_id, uid, text="/upload"))
+            updates.append(_message(next_id + 1, uid, document=document))
+            updates.append(_message(next_id + 2, uid, text=" ".join(random.sample(WORDS, 2))))
+            updates.append(_message(next_id + 3, uid, text=random.choice(bot.ALLOWED_SUBJECTS)))
+    return updates
+
+
+# --- Fake Bot API ---
+
+class FakeApiHandler(tornado.web.RequestHandler):
+    """Answers Bot API calls after ``latency`` seconds; getUpdates serves ``feed``."""
+
+    def initialize(self, state):
+        self.state = state
+
+    async def post(self, method):
+        self.state["calls"] += 1
+        if method == "getUpdates":
+            result = await self._get_updates()
+        else:
+            await asyncio.sleep(self.state["latency"] * random.uniform(0.5, 1.5))
+            result = self._result(method)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"ok": True, "result": result}))
+
+    async def _get_updates(self):
+        feed = self.state["feed"]
+        try:
+            batch = [await asyncio.wait_for(feed.get(), timeout=1.0)]
+        except asyncio.TimeoutError:
+            return []
+        while not feed.empty() and len(batch) < 100:
+            batch.append(feed.get_nowait())
+        return batch
+
+    def _result(self, method):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText", "sendDocument", "sendPhoto"):
+            chat_id = int(self.get_body_argument("chat_id", "1"))
+            self.state["message_id"] += 1
+            return {
+                "message_id": self.state["message_id"],
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": "-",
+            }
+        return True
+
+
+# --- Drivers ---
+
+async def _wait_turn(started, index, rate):
+    # Open-loop pacing: update ``index`` is due ``index / rate`` seconds in
+    if rate:
+        delay = started + index / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def drive_polling(application, updates, state, rate):
+    await application.updater.start_polling(poll_interval=0.0, timeout=1)
+    started = time.perf_counter()
+    for index, update in enumerate(updates):
+        await _wait_turn(started, index, rate)
+        state["sent"][update["update_id"]] = time.perf_counter()
+        state["feed"].put_nowait(update)
+    await state["done_event"].wait()
+    await application.updater.stop()
+
+
+async def drive_webhook(application, updates, state, concurrency, workers, rate):
+    port = _free_port()
+    secret = webhook.default_secret(TOKEN)
+    pipeline = webhook.UpdatePipeline(application, workers=workers, max_size=len(updates))
+    pipeline.start()
+    server = webhook.make_app(TOKEN, pipeline, secret).listen(port, address="127.0.0.1")
+    url = f"http://127.0.0.1:{port}/{TOKEN}"
+    headers = {webhook.SECRET_HEADER: secret, "Content-Type": "application/json"}
+    tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=concurrency)
+    client = tornado.httpclient.AsyncHTTPClient()
+
+    # Each sender owns a slice of the users and posts their updates in order,
+    # like Telegram, which never delivers one chat's updates out of order.
+    started = time.perf_counter()
+
+    async def sender(index):
+        for position, update in enumerate(updates):
+            if _sender_of(update) % concurrency != index:
+                continue
+            await _wait_turn(started, position, rate)
+            body = json.dumps(update)
+            state["sent"][update["update_id"]] = time.perf_counter()
+            while True:
+                response = await client.fetch(url, method="POST", body=body, headers=headers, raise_error=False)
+                if response.code != 503:
+                    break
+                await asyncio.sleep(0.05)
+
+    await asyncio.gather(*(sender(index) for index in range(concurrency)))
+    await state["done_event"].wait()
+    await pipeline.stop()
+    server.stop()
+
+
+def _sender_of(update):
+    payload = update.get("message") or update.get("callback_query") or update.get("inline_query")
+    return payload["from"]["id"]
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run(args):
+    random.seed(args.seed)
+    database.init_db()
+    print(f"Seeding {args.notes} notes...")
+    started = time.perf_counter()
+    seed(args.notes)
+    print(f"  done in {time.perf_counter() - started:.1f}s")
+    updates = make_updates(args.updates, args.users, args.notes)
+
+    state = {
+        "latency": args.latency / 1000, "calls": 0, "message_id": 0,
+        "feed": asyncio.Queue(), "sent": {}, "done": {}, "done_event": asyncio.Event(),
+    }
+    api_port = _free_port()
+    api_server = tornado.web.Application([(r"/bot[^/]+/(\w+)", FakeApiHandler, {"state": state})]).listen(
+        api_port, address="127.0.0.1"
+    )
+    os.environ["BOT_API_URL"] = f"http://127.0.0.1:{api_port}"
+    os.environ["API_RATE_LIMIT"] = str(args.api_rate)
+    application = bot.build_application(TOKEN)
+
+    async def record(update, context):
+        state["done"][update.update_id] = time.perf_counter()
+        if len(state["done"]) >= len(updates):
+            state["done_event"].set()
+
+    # Runs after the bot's own handlers (group 0) have finished with the update
+    application.add_handler(TypeHandler(Update, record), group=100)
+
+    await webhook.start_application(application)
+    try:
+        if args.mode == "polling":
+            await drive_polling(application, updates, state, args.rate)
+        else:
+            await drive_webhook(application, updates, state, args.concurrency, args.workers, args.rate)
+    finally:
+        await webhook.stop_application(application)
+        api_server.stop()
+
+    latencies = [state["done"][uid] - sent for uid, sent in state["sent"].items() if uid in state["done"]]
+    elapsed = max(state["done"].values()) - min(state["sent"].values())
+    print(f"mode={args.mode} notes={args.notes} updates={len(updates)} users={args.users} api_latency={args.latency}ms")
+    print(f"throughput={len(updates) / elapsed:,.1f} updates/s api_calls={state['calls']}")
+    print(f"latency p50={_percentile(latencies, 50) * 1000:.1f}ms "
+          f"p99={_percentile(latencies, 99) * 1000:.1f}ms max={max(latencies) * 1000:.1f}ms")
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux; includes the fake API server
+        print(f"peak_rss={resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=("webhook", "polling"), default="webhook")
+    parser.add_argument("--notes", type=int, default=10000, help="notes seeded into the database")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=50, help="mean fake Bot API latency in ms")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="offered updates per second (0 sends everything at once)")
+    parser.add_argument("--api-rate", type=float, default=1e6,
+                        help="bot-wide outgoing message limit (Telegram enforces about 30/s)")
+    parser.add_argument("--concurrency", type=int, default=20, help="parallel webhook connections")
+    parser.add_argument("--workers", type=int, default=4, help="webhook pipeline workers")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    # Per-request access logs would dominate the run
+    for name in ("httpx", "tornado.access", "telegram.ext"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    try:
+        asyncio.run(run(args))
+    finally:
+        database.close_all()
+
+
+if __name__ == "__main__":
+    main()
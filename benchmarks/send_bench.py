@@ -0,0 +1,120 @@
+"""Outgoing Bot API throughput at varying concurrency and pool sizes.
+
+Sends sendMessage calls through the bot's own HTTP client and rate limiter
+(with the in-flight cap set to the pool size, as build_application does) to
+a local stand-in for the Bot API that answers after a configurable latency,
+and reports messages per second for each pool size and number of concurrent
+callers. With
+``--no-keepalive`` every call opens a new connection, showing what
+connection reuse saves. The stand-in speaks HTTP/1.1 only, so
+BOT_API_HTTP2 cannot be measured here.
+
+    python benchmarks/send_bench.py --pools 1,4,16,64,256 --concurrency 1,16,256
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+import tornado.web  # noqa: E402
+from telegram.ext import ExtBot  # noqa: E402
+
+import metrics  # noqa: E402
+import ratelimit  # noqa: E402
+
+TOKEN = "123456:BENCHMARK"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+class FakeApiHandler(tornado.web.RequestHandler):
+    """Answers every Bot API call with a sent message after ``latency`` seconds."""
+
+    def initialize(self, state):
+        self.state = state
+
+    async def post(self, method):
+        # One stream per TCP connection, however many requests it carries
+        self.state["streams"].add(self.request.connection.stream)
+        await asyncio.sleep(self.state["latency"])
+        if method == "getMe":
+            result = BOT_USER
+        else:
+            result = {"message_id": 1, "date": int(time.time()), "chat": {"id": 1, "type": "private"}, "text": "-"}
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"ok": True, "result": result}))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def measure(base_url, state, pool_size, concurrency, messages, keepalive):
+    limits = httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size if keepalive else 0,
+        keepalive_expiry=60 if keepalive else 0,
+    )
+    request = metrics.InstrumentedRequest(
+        connection_pool_size=pool_size,
+        pool_timeout=None,
+        httpx_kwargs={"limits": limits},
+    )
+    # Messages are not rate limited here; only the in-flight cap applies
+    limiter = ratelimit.ApiRateLimiter(rate=1e9, max_in_flight=pool_size)
+    async with ExtBot(TOKEN, base_url=f"{base_url}/bot", request=request, rate_limiter=limiter) as bot:
+        state["streams"] = set()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def send(i):
+            async with semaphore:
+                await bot.send_message(chat_id=i, text="benchmark")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(i) for i in range(messages)))
+        elapsed = time.perf_counter() - started
+    return messages / elapsed, len(state["streams"])
+
+
+async def run(args):
+    port = _free_port()
+    state = {"latency": args.latency / 1000, "streams": set()}
+    server = tornado.web.Application([(r"/bot[^/]+/(\w+)", FakeApiHandler, {"state": state})]).listen(
+        port, address="127.0.0.1"
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    print(f"latency={args.latency}ms messages={args.messages} keepalive={not args.no_keepalive}")
+    print(f"{'pool':>6} {'concurrency':>12} {'msg/s':>10} {'connections':>12}")
+    try:
+        for pool_size in args.pools:
+            for concurrency in args.concurrency:
+                rate, opened = await measure(base_url, state, pool_size, concurrency, args.messages, not args.no_keepalive)
+                print(f"{pool_size:>6} {concurrency:>12} {rate:>10.1f} {opened:>12}")
+    finally:
+        server.stop()
+
+
+def _ints(value):
+    return [int(part) for part in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pools", type=_ints, default=[1, 4, 16, 64, 256], help="comma-separated pool sizes")
+    parser.add_argument("--concurrency", type=_ints, default=[1, 16, 256],
+                        help="comma-separated numbers of calls in flight")
+    parser.add_argument("--messages", type=int, default=1000, help="calls per measurement")
+    parser.add_argument("--latency", type=float, default=50, help="fake Bot API latency in ms")
+    parser.add_argument("--no-keepalive", action="store_true", help="open a new connection for every call")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Cold-start time of the bot process.
+
+Imports bot.py in fresh interpreters under ``python -X importtime`` and
+reports the wall time of the import, the modules bot.py imports with
+the largest cumulative import time, and how long build_application and database.init_db
+take afterwards. Run it before and after touching top-level imports to keep
+restarts on free-tier hosts fast.
+
+    python benchmarks/startup.py --runs 5 --top 15
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child interpreter; prints one "phase seconds" line per step
+CHILD = """
+import sys, time
+started = time.perf_counter()
+import bot
+imported = time.perf_counter()
+import database
+database.DB_NAME = sys.argv[1]
+database.init_db()
+migrated = time.perf_counter()
+bot.build_application("123456:BENCHMARK")
+built = time.perf_counter()
+print("import", imported - started)
+print("init_db", migrated - imported)
+print("build_application", built - migrated)
+"""
+
+
+def run_once(db_path):
+    # -X importtime writes to stderr: "import time: self [us] | cumulative | package"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD, db_path],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    phases = {}
+    for line in result.stdout.splitlines():
+        name, seconds = line.split()
+        phases[name] = float(seconds)
+    modules, pending = {}, {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, package = line[len("import time:"):].split("|")
+        depth = (len(package) - len(package.lstrip()) - 1) // 2
+        # A module's imports are listed before it, so keep the direct imports
+        # seen since the last top-level entry once that entry turns out to be bot
+        if depth == 1:
+            pending[package.strip()] = int(cumulative) / 1e6
+        elif depth == 0:
+            if package.strip() == "bot":
+                modules.update(pending)
+            pending = {}
+    return phases, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters to start")
+    parser.add_argument("--top", type=int, default=15, help="slowest direct imports to list")
+    args = parser.parse_args()
+
+    phases, modules = {}, {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for run in range(args.runs):
+            # The first run also creates the database; later runs find it migrated
+            run_phases, run_modules = run_once(os.path.join(tmp, "startup.db"))
+            for name, seconds in run_phases.items():
+                phases.setdefault(name, []).append(seconds)
+            for name, seconds in run_modules.items():
+                modules.setdefault(name, []).append(seconds)
+
+    print(f"{args.runs} runs, median ms:")
+    for name, samples in phases.items():
+        print(f"  {name:<20} {statistics.median(samples) * 1000:8.1f}")
+    print("slowest direct imports of bot.py (cumulative ms):")
+    medians = {name: statistics.median(samples) for name, samples in modules.items()}
+    for name, seconds in sorted(medians.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"  {name:<40} {seconds * 1000:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
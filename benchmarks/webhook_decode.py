@@ -0,0 +1,147 @@
+"""Per-update webhook decode and dispatch benchmark.
+
+Compares the original path (tornado.escape.json_decode, Update.de_json and
+handler lookup for every update) with the fast path in webhook.py (raw-bytes
+JSON decoding plus dropping unroutable callback queries before de_json).
+
+    python benchmarks/webhook_decode.py --updates 20000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tornado.escape  # noqa: E402
+from telegram import Update, User  # noqa: E402
+
+import database  # noqa: E402
+
+_tmp = tempfile.TemporaryDirectory()
+database.DB_NAME = os.path.join(_tmp.name, "bench.db")
+
+import bot  # noqa: E402
+import webhook  # noqa: E402
+
+
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"User{uid}"}
+
+
+def message_update(update_id, uid, text):
+    entities = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else []
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1700000000,
+            "chat": {"id": uid, "type": "private", "first_name": f"User{uid}"},
+            "from": _user(uid),
+            "text": text,
+            "entities": entities,
+        },
+    }
+
+
+def callback_update(update_id, uid, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(uid),
+            "chat_instance": "1",
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": 1700000000,
+                "chat": {"id": uid, "type": "private", "first_name": f"User{uid}"},
+                "text": "Select a subject to browse:",
+            },
+        },
+    }
+
+
+def make_bodies(count, stale_ratio):
+    bodies = []
+    for update_id in range(1, count + 1):
+        uid = random.randint(1, 5000)
+        roll = random.random()
+        if roll < stale_ratio:
+            # Buttons from keyboards of older bot versions nobody handles anymore
+            body = callback_update(update_id, uid, f"legacy_{update_id}")
+        elif roll < 0.6:
+            body = callback_update(update_id, uid, random.choice(["sub_BIOLOGY II", f"note_{update_id}", "back_to_subjects"]))
+        else:
+            body = message_update(update_id, uid, random.choice(["/start", "/browse", "/search cell", "hello"]))
+        bodies.append(json.dumps(body).encode())
+    return bodies
+
+
+def route(application, update):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            check = handler.check_update(update)
+            if check is not None and check is not False:
+                return handler
+    return None
+
+
+def bench_original(application, bodies):
+    started = time.perf_counter()
+    for body in bodies:
+        data = tornado.escape.json_decode(body)
+        route(application, Update.de_json(data, application.bot))
+    return time.perf_counter() - started
+
+
+def bench_fast(application, bodies):
+    pipeline = webhook.UpdatePipeline(application)
+    pipeline._callback_patterns = webhook.callback_patterns(application)
+    started = time.perf_counter()
+    for body in bodies:
+        data = webhook.loads(body)
+        if pipeline.is_routable(data):
+            route(application, Update.de_json(data, application.bot))
+    return time.perf_counter() - started
+
+
+def bench_decode_only(bodies):
+    results = {"tornado.escape": lambda: [tornado.escape.json_decode(b) for b in bodies]}
+    results[f"webhook.loads ({webhook.JSON_BACKEND})"] = lambda: [webhook.loads(b) for b in bodies]
+    for name, func in results.items():
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        print(f"  {name:<28} {elapsed / len(bodies) * 1e6:8.2f} us/update")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--stale", type=float, default=0.1,
+                        help="share of callback queries no handler matches")
+    parser.add_argument("--rounds", type=int, default=3, help="report the best of N rounds")
+    args = parser.parse_args()
+
+    random.seed(1)
+    bodies = make_bodies(args.updates, args.stale)
+    application = bot.build_application("123456:BENCHMARK")
+    # CommandHandler needs the bot's username, normally fetched by initialize()
+    application.bot._bot_user = User(123456, "Bench", True, username="bench_bot")
+
+    print(f"{args.updates} updates, JSON backend: {webhook.JSON_BACKEND}")
+    print("decode only:")
+    bench_decode_only(bodies)
+    print("decode + Update.de_json + handler lookup:")
+    for name, func in (("original", bench_original), ("fast path", bench_fast)):
+        elapsed = min(func(application, bodies) for _ in range(args.rounds))
+        print(f"  {name:<28} {elapsed / len(bodies) * 1e6:8.2f} us/update  "
+              f"({len(bodies) / elapsed:,.0f} updates/s)")
+
+
+if __name__ == "__main__":
+    main()
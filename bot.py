@@ -1,28 +1,52 @@
+import importlib.util
+import functools
 import logging
 import os
 import asyncio
 import sys
 import random
-import tornado.web
-import tornado.escape
+import tempfile
+from datetime import date
 from html import escape
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultCachedDocument,
+    InlineQueryResultCachedPhoto,
+    InlineQueryResultsButton,
+    ReplyKeyboardMarkup,
+    ReplyKeyboardRemove,
+)
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ApplicationHandlerStop,
     ConversationHandler,
     ContextTypes,
+    InlineQueryHandler,
+    TypeHandler,
     filters,
 )
+import httpx
 from dotenv import load_dotenv
+import broadcast
+import catalog
 import database
+import metrics
+import persistence
+import ratelimit
+from cache import TTLCache
+from writebehind import CounterQueue, WriteBehindQueue
 
 # Load environment variables
 load_dotenv()
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ADMIN_ID = os.getenv("ADMIN_ID")
+metrics.ENABLED = os.getenv("METRICS", "0") == "1"
 
 # Enable logging
 logging.basicConfig(
@@ -42,12 +66,98 @@ ALLOWED_SUBJECTS = [
     "AGRICULTURE II"
 ]
 
-# Initialize database
-database.init_db()
+# Static screens are built once at import; Telegram objects are immutable,
+# so the same markup can be sent to every user.
+HELP_TEXT = (
+    "📚 <b>ASper21_ExcelBot Help</b>\n\n"
+    "<b>/upload</b> - Share a new note (PDF, Image, etc.)\n"
+    "<b>/browse</b> - Browse notes by subject\n"
+    "<b>/search [keyword]</b> - Search notes by title or subject\n"
+    "<b>/my_notes</b> - See and delete your own shared notes\n"
+    "<b>/top</b> - See the most downloaded notes\n"
+    "<b>/cancel</b> - Stop the current upload process\n"
+    "<b>/about</b> - Step-by-step guide on how to use the bot"
+)
+
+ABOUT_TEXT = (
+    "ℹ️ <b>About ASper21_ExcelBot</b>\n\n"
+    "This bot helps students share and browse notes for:\n"
+    "• BIOLOGY II\n"
+    "• CHEMISTRY II\n"
+    "• PHYSICS II\n"
+    "• MATHEMATICS II\n"
+    "• AGRICULTURE II\n\n"
+    "<b>How to upload a note</b>\n"
+    "1. Type <code>/upload</code>.\n"
+    "2. Send your file (PDF, image, or document).\n"
+    "3. Enter a short title for the note.\n"
+    "4. Choose the correct subject from the buttons.\n"
+    "Your note is then saved and shared with others.\n\n"
+    "<b>How to browse notes</b>\n"
+    "• Type <code>/browse</code> and pick a subject.\n"
+    "• Tap on a note to receive the file.\n\n"
+    "<b>How to search notes</b>\n"
+    "• Type <code>/search keyword</code>\n"
+    "  Example: <code>/search cell</code>\n"
+    "• Tap a result to get the note.\n\n"
+    "<b>How to manage your uploads</b>\n"
+    "• Type <code>/my_notes</code> to see what you uploaded.\n"
+    "• Use the 🗑 buttons to delete your own notes.\n\n"
+    "You can always use <code>/help</code> to quickly see all commands."
+)
+
+SUBJECTS_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(subject, callback_data=f"sub_{subject}")] for subject in ALLOWED_SUBJECTS]
+)
+BACK_BUTTON = InlineKeyboardButton("🔙 Back to Subjects", callback_data="back_to_subjects")
+BACK_MARKUP = InlineKeyboardMarkup([[BACK_BUTTON]])
+UPLOAD_SUBJECT_MARKUP = ReplyKeyboardMarkup(
+    [[subject] for subject in ALLOWED_SUBJECTS], one_time_keyboard=True, resize_keyboard=True
+)
+
+# Subject page keyboards, keyed by the subject's data version so any write to
+# the subject makes its old pages unreachable (see database.subject_version).
+page_markups = TTLCache(maxsize=256, ttl=300)
+
+# /start registrations are batched: sign-up bursts become one transaction per
+# interval instead of one commit per user.
+user_writes = WriteBehindQueue(database.add_users, interval=2.0, max_pending=5000)
+
+# Flood protection: each user may send USER_RATE_LIMIT updates per second on
+# average, with bursts of up to USER_BURST.
+user_limiter = ratelimit.UserRateLimiter(
+    rate=float(os.getenv("USER_RATE_LIMIT", 1)),
+    capacity=int(os.getenv("USER_BURST", 5)),
+)
+
+# Download taps are summed per note in memory and flushed as one UPDATE.
+downloads = CounterQueue(database.record_downloads, interval=10.0, max_pending=5000)
+
+async def throttle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Drop updates from users over their rate limit before any handler runs."""
+    user = update.effective_user
+    if user is None or str(user.id) == ADMIN_ID:
+        return
+    # Inline queries arrive once per keystroke; they are debounced instead
+    if update.inline_query:
+        return
+    rejected = user_limiter.hit(user.id)
+    if not rejected:
+        return
+    if metrics.ENABLED:
+        metrics.THROTTLED.inc("user")
+    # Only the first rejection in a row is answered, so flooding costs no API calls
+    if rejected == 1:
+        if update.callback_query:
+            await update.callback_query.answer("⏳ Too many requests. Please wait a moment.")
+        elif update.effective_message:
+            await update.effective_message.reply_text("⏳ You're sending requests too quickly. Please wait a moment.")
+    raise ApplicationHandlerStop
 
+@metrics.timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    database.add_user(user.id, user.full_name)
+    await user_writes.put(user.id, (user.id, user.full_name))
     
     await update.message.reply_html(
         rf"Hi {user.mention_html()}! Welcome to ASper21_ExcelBot. 📚"
@@ -59,52 +169,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "\n/browse - View available notes"
         "\n/search - Find notes by keyword"
         "\n/my_notes - Manage your uploads"
+        "\n/top - See the most downloaded notes"
         "\n/help - Show this help message"
     )
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.message.reply_text(
-        "📚 <b>ASper21_ExcelBot Help</b>\n\n"
-        "<b>/upload</b> - Share a new note (PDF, Image, etc.)\n"
-        "<b>/browse</b> - Browse notes by subject\n"
-        "<b>/search [keyword]</b> - Search notes by title or subject\n"
-        "<b>/my_notes</b> - See and delete your own shared notes\n"
-        "<b>/cancel</b> - Stop the current upload process\n"
-        "<b>/about</b> - Step-by-step guide on how to use the bot",
-        parse_mode="HTML"
-    )
+    await update.message.reply_text(HELP_TEXT, parse_mode="HTML")
 
 async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.message.reply_text(
-        "ℹ️ <b>About ASper21_ExcelBot</b>\n\n"
-        "This bot helps students share and browse notes for:\n"
-        "• BIOLOGY II\n"
-        "• CHEMISTRY II\n"
-        "• PHYSICS II\n"
-        "• MATHEMATICS II\n"
-        "• AGRICULTURE II\n\n"
-        "<b>How to upload a note</b>\n"
-        "1. Type <code>/upload</code>.\n"
-        "2. Send your file (PDF, image, or document).\n"
-        "3. Enter a short title for the note.\n"
-        "4. Choose the correct subject from the buttons.\n"
-        "Your note is then saved and shared with others.\n\n"
-        "<b>How to browse notes</b>\n"
-        "• Type <code>/browse</code> and pick a subject.\n"
-        "• Tap on a note to receive the file.\n\n"
-        "<b>How to search notes</b>\n"
-        "• Type <code>/search keyword</code>\n"
-        "  Example: <code>/search cell</code>\n"
-        "• Tap a result to get the note.\n\n"
-        "<b>How to manage your uploads</b>\n"
-        "• Type <code>/my_notes</code> to see what you uploaded.\n"
-        "• Use the 🗑 buttons to delete your own notes.\n\n"
-        "You can always use <code>/help</code> to quickly see all commands.",
-        parse_mode="HTML"
-    )
+    await update.message.reply_text(ABOUT_TEXT, parse_mode="HTML")
 
 # --- Search Functionality ---
 
+@metrics.timed_handler
 async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Search for notes by keyword."""
     if not context.args:
@@ -112,7 +189,12 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     query = " ".join(context.args)
-    results = database.search_notes(query)
+    results = await database.run(database.search_notes, query)
+    heading = f"Search results for '{query}':"
+    if not results:
+        # Nothing contains the words as typed; look for near matches instead
+        results = await database.run(database.search_notes_fuzzy, query)
+        heading = f"No exact matches for '{query}'. Did you mean:"
 
     if not results:
         await update.message.reply_text(f"No results found for '{query}'.")
@@ -123,18 +205,114 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         for res in results
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(f"Search results for '{query}':", reply_markup=reply_markup)
+    await update.message.reply_text(heading, reply_markup=reply_markup)
+
+# --- Inline Mode ---
+
+# Results per inline page, and how deep users may scroll
+INLINE_PAGE_SIZE = 20
+INLINE_MAX_RESULTS = 200
+# Queries are trimmed to this length and shorter ones get no search
+INLINE_MAX_QUERY = 64
+INLINE_MIN_QUERY = 2
+# A user's query is only searched once they stop typing for this long
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", 0.3))
+# How long Telegram may cache an answer and serve it to anyone
+INLINE_CACHE_TIME = 300
+
+INLINE_BROWSE_BUTTON = InlineQueryResultsButton(text="📚 Browse all notes", start_parameter="inline")
+
+# user_id -> debounced task that will answer that user's latest inline query.
+# Superseded tasks see they were replaced when they wake up and do nothing;
+# each task removes its own entry when it finishes.
+_inline_pending = {}
+
+def _forget_inline_task(user_id, task):
+    if _inline_pending.get(user_id) is task:
+        del _inline_pending[user_id]
+
+def _inline_result(note):
+    note_id, file_id, file_name, title, subject, media_type = note
+    caption = f"Title: {title}\nSubject: {subject}"
+    if media_type == "photo":
+        return InlineQueryResultCachedPhoto(
+            id=str(note_id), photo_file_id=file_id, title=title, description=subject, caption=caption
+        )
+    return InlineQueryResultCachedDocument(
+        id=str(note_id), document_file_id=file_id, title=title, description=subject, caption=caption
+    )
+
+async def _answer_inline_query(inline_query, text, offset, delay):
+    user_id = inline_query.from_user.id
+    if delay:
+        await asyncio.sleep(delay)
+        if _inline_pending.get(user_id) is not asyncio.current_task():
+            # The user typed on; a newer query replaced this one
+            return
+
+    notes = await database.run(database.search_notes_inline, text, INLINE_PAGE_SIZE + 1, offset)
+    next_offset = ""
+    if len(notes) > INLINE_PAGE_SIZE and offset + INLINE_PAGE_SIZE < INLINE_MAX_RESULTS:
+        next_offset = str(offset + INLINE_PAGE_SIZE)
+    try:
+        await inline_query.answer(
+            [_inline_result(note) for note in notes[:INLINE_PAGE_SIZE]],
+            cache_time=INLINE_CACHE_TIME,
+            next_offset=next_offset,
+            button=INLINE_BROWSE_BUTTON if offset == 0 else None,
+        )
+    except BadRequest as e:
+        # The query expired while waiting or the user typed on
+        logger.debug(f"Inline answer dropped: {e}")
+
+@metrics.timed_handler
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Search notes from any chat via @bot <keyword>, answering with the files themselves."""
+    inline = update.inline_query
+    text = " ".join(inline.query.split())[:INLINE_MAX_QUERY]
+    offset = int(inline.offset) if inline.offset.isdigit() else 0
+
+    if len(text) < INLINE_MIN_QUERY:
+        _inline_pending.pop(inline.from_user.id, None)
+        try:
+            await inline.answer([], cache_time=INLINE_CACHE_TIME, button=INLINE_BROWSE_BUTTON)
+        except BadRequest as e:
+            logger.debug(f"Inline answer dropped: {e}")
+        return
+
+    # Only the first page is debounced; scrolling for more is deliberate.
+    # Waiting in a task keeps this handler from holding up the user's next
+    # keystroke, which is what replaces the pending one.
+    delay = INLINE_DEBOUNCE if offset == 0 else 0
+    task = context.application.create_task(_answer_inline_query(inline, text, offset, delay), update=update)
+    if delay:
+        _inline_pending[inline.from_user.id] = task
+        task.add_done_callback(functools.partial(_forget_inline_task, inline.from_user.id))
 
 # --- User Dashboard ---
 
-async def my_notes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """List notes uploaded by the user."""
-    user_id = update.effective_user.id
-    notes = database.get_user_notes(user_id)
+def _page_nav_row(prefix, notes, date_index, has_prev, has_next, suffix=""):
+    """Build the Prev/Next buttons for a page of notes.
 
+    The callback data carries the keyset cursor (note id and upload_date) of
+    the first or last note shown, e.g. ``sp_n_42_2025-01-31 10:00:00_PHYSICS II``.
+    """
+    row = []
+    if has_prev:
+        first = notes[0]
+        row.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"{prefix}_p_{first[0]}_{first[date_index]}{suffix}"))
+    if has_next:
+        last = notes[-1]
+        row.append(InlineKeyboardButton("Next ➡️", callback_data=f"{prefix}_n_{last[0]}_{last[date_index]}{suffix}"))
+    return row
+
+async def _my_notes_page(user_id, cursor=None, backward=False):
+    """Return the text and keyboard for one page of the user's notes."""
+    notes, has_prev, has_next = await database.run(
+        database.get_user_notes_page, user_id, cursor, backward
+    )
     if not notes:
-        await update.message.reply_text("You haven't uploaded any notes yet. Use /upload to start sharing!")
-        return
+        return None, None
 
     text = "📂 <b>Your Uploaded Notes:</b>\n\n"
     keyboard = []
@@ -144,10 +322,41 @@ async def my_notes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         safe_subject = escape(subject)
         text += f"• {safe_title} ({safe_subject})\n"
         keyboard.append([InlineKeyboardButton(f"🗑 Delete '{title}'", callback_data=f"del_{note_id}")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    nav_row = _page_nav_row("mp", notes, 3, has_prev, has_next)
+    if nav_row:
+        keyboard.append(nav_row)
+    return text, InlineKeyboardMarkup(keyboard)
+
+@metrics.timed_handler
+async def my_notes_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """List notes uploaded by the user."""
+    user_id = update.effective_user.id
+    text, reply_markup = await _my_notes_page(user_id)
+
+    if not text:
+        await update.message.reply_text("You haven't uploaded any notes yet. Use /upload to start sharing!")
+        return
+
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="HTML")
 
+async def handle_my_notes_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show another page of the user's notes."""
+    query = update.callback_query
+    await query.answer()
+
+    _, direction, note_id, upload_date = query.data.split("_", 3)
+    text, reply_markup = await _my_notes_page(
+        update.effective_user.id, (upload_date, int(note_id)), direction == "p"
+    )
+
+    if not text:
+        await query.edit_message_text("No more notes to show. Use /my_notes to start over.")
+        return
+
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="HTML")
+
+@metrics.timed_handler
 async def handle_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle note deletion."""
     query = update.callback_query
@@ -156,13 +365,13 @@ async def handle_delete_callback(update: Update, context: ContextTypes.DEFAULT_T
     note_id = int(query.data.replace("del_", ""))
     user_id = update.effective_user.id
     
-    success = database.delete_note(note_id, user_id)
+    success = await database.run(database.delete_note, note_id, user_id)
     if success:
         await query.edit_message_text("✅ Note successfully deleted.")
     else:
         # Check if admin
         if str(user_id) == str(ADMIN_ID):
-             if database.force_delete_note(note_id):
+             if await database.run(database.force_delete_note, note_id):
                  await query.edit_message_text("✅ Note deleted by Admin.")
                  return
         
@@ -179,15 +388,40 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         # Ignore unauthorized users
         return
 
-    user_count, note_count = database.get_stats()
-    
+    stats = await database.run(database.get_stats)
+
+    day_lines = ""
+    for day, uploads, uploaders, new_users in stats["days"]:
+        day_lines += f"{day}: {uploads} / {uploaders} / {new_users}\n"
+    subject_lines = ""
+    for subject, notes in stats["subjects"]:
+        subject_lines += f"• {escape(subject)}: {notes}\n"
+
+    cache_lines = ""
+    caches = {**database.cache_stats(), "keyboards": page_markups.stats()}
+    for name, (hits, misses, size) in caches.items():
+        lookups = hits + misses
+        hit_rate = hits * 100 // lookups if lookups else 0
+        cache_lines += f"🗄 {name.title()} cache: {hit_rate}% hits ({hits}/{lookups}), {size} entries\n"
+
     await update.message.reply_text(
         "🕵️‍♂️ <b>Admin Dashboard</b>\n\n"
-        f"👥 Total Users: {user_count}\n"
-        f"📄 Total Notes: {note_count}\n\n"
+        f"👥 Total Users: {stats['users']}\n"
+        f"📄 Total Notes: {stats['notes']}\n"
+        f"✍️ Uploaders: {stats['uploaders']}\n\n"
+        "📅 <b>Last 7 days (UTC)</b> - uploads / uploaders / new users\n"
+        f"{day_lines}\n"
+        "📚 <b>Largest subjects</b>\n"
+        f"{subject_lines}\n"
+        f"{cache_lines}\n"
         "Commands:\n"
         "/broadcast [message] - Send message to all users\n"
-        "/delete_note [id] - Force delete a note by ID",
+        "/broadcast_status [id] - Show broadcast progress\n"
+        "/broadcast_resume [id] - Resume an interrupted broadcast\n"
+        "/delete_note [id] - Force delete a note by ID\n"
+        "/merge_duplicates - Remove notes that share the same file\n"
+        "/export - Download all notes and users as a catalog file\n"
+        "/import - Reply to a catalog file to load it",
         parse_mode="HTML"
     )
 
@@ -203,19 +437,81 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     message = " ".join(context.args)
     safe_message = escape(message)
-    users = database.get_all_users()
-    
-    success_count = 0
-    await update.message.reply_text(f"📢 Starting broadcast to {len(users)} users...")
-    
-    for uid in users:
-        try:
-            await context.bot.send_message(chat_id=uid, text=f"📢 <b>Announcement:</b>\n\n{safe_message}", parse_mode="HTML")
-            success_count += 1
-        except Exception as e:
-            logger.warning(f"Failed to send to {uid}: {e}")
-    
-    await update.message.reply_text(f"✅ Broadcast complete. Sent to {success_count}/{len(users)} users.")
+    text = f"📢 <b>Announcement:</b>\n\n{safe_message}"
+    job_id = await database.run(database.create_broadcast_job, text)
+    job = await database.run(database.get_broadcast_job, job_id)
+
+    await update.message.reply_text(
+        f"📢 Broadcast #{job_id} started for {job[3]} users.\n"
+        f"Use /broadcast_status {job_id} to follow its progress."
+    )
+    broadcast.start_job(context.bot, job_id, text, notify_chat_id=update.effective_chat.id)
+
+async def broadcast_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the progress of a broadcast (the latest one by default)."""
+    user_id = str(update.effective_user.id)
+    if user_id != ADMIN_ID:
+        return
+
+    try:
+        job_id = int(context.args[0]) if context.args else None
+    except ValueError:
+        await update.message.reply_text("Invalid broadcast ID.")
+        return
+
+    job = await database.run(database.get_broadcast_job, job_id)
+    if not job:
+        await update.message.reply_text("No broadcast found.")
+        return
+
+    job_id, _, status, total, sent, failed, created_date, _ = job
+    if status == "done":
+        state = "✅ Complete"
+    elif broadcast.is_running(job_id):
+        state = "⏳ Sending"
+    else:
+        state = f"⏸ Interrupted - use /broadcast_resume {job_id}"
+    processed = sent + failed
+    percent = processed * 100 // total if total else 100
+
+    await update.message.reply_text(
+        f"📢 <b>Broadcast #{job_id}</b> ({created_date})\n\n"
+        f"Status: {state}\n"
+        f"Progress: {processed}/{total} ({percent}%)\n"
+        f"Sent: {sent}\n"
+        f"Failed: {failed}",
+        parse_mode="HTML"
+    )
+
+async def broadcast_resume_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Resume an interrupted broadcast (the latest one by default)."""
+    user_id = str(update.effective_user.id)
+    if user_id != ADMIN_ID:
+        return
+
+    try:
+        job_id = int(context.args[0]) if context.args else None
+    except ValueError:
+        await update.message.reply_text("Invalid broadcast ID.")
+        return
+
+    job = await database.run(database.get_broadcast_job, job_id)
+    if not job:
+        await update.message.reply_text("No broadcast found.")
+        return
+
+    job_id, text, status, total, sent, failed = job[:6]
+    if status == "done":
+        await update.message.reply_text(f"Broadcast #{job_id} is already complete.")
+        return
+    if broadcast.is_running(job_id):
+        await update.message.reply_text(f"Broadcast #{job_id} is already being sent.")
+        return
+
+    await update.message.reply_text(
+        f"📢 Resuming broadcast #{job_id}: {total - sent - failed} users left."
+    )
+    broadcast.start_job(context.bot, job_id, text, notify_chat_id=update.effective_chat.id)
 
 async def admin_delete_note(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Force delete a note by ID."""
@@ -231,13 +527,62 @@ async def admin_delete_note(update: Update, context: ContextTypes.DEFAULT_TYPE)
         note_id = int(context.args[0])
         # We need a force delete function in database
         # For now, let's just assume we'll add `force_delete_note` to database.py
-        if database.force_delete_note(note_id):
+        if await database.run(database.force_delete_note, note_id):
              await update.message.reply_text(f"✅ Note {note_id} deleted.")
         else:
              await update.message.reply_text(f"❌ Note {note_id} not found.")
     except ValueError:
         await update.message.reply_text("Invalid Note ID.")
 
+async def merge_duplicates_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Remove duplicate notes, keeping the first upload of each file."""
+    user_id = str(update.effective_user.id)
+    if user_id != ADMIN_ID:
+        return
+
+    removed = await database.run(database.merge_duplicate_notes)
+    await update.message.reply_text(f"✅ Removed {removed} duplicate notes.")
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send the whole catalog as a gzipped JSON Lines document."""
+    user_id = str(update.effective_user.id)
+    if user_id != ADMIN_ID:
+        return
+
+    await update.message.reply_text("📦 Exporting catalog...")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, f"catalog-{date.today().isoformat()}.jsonl.gz")
+        user_count, note_count = await database.run(catalog.write_catalog, path)
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                f, caption=f"✅ Exported {note_count} notes and {user_count} users."
+            )
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Load a catalog file made by /export; existing users and files are skipped."""
+    user_id = str(update.effective_user.id)
+    if user_id != ADMIN_ID:
+        return
+
+    reply = update.message.reply_to_message
+    if not reply or not reply.document:
+        await update.message.reply_text("Usage: reply to a catalog file from /export with /import")
+        return
+
+    await update.message.reply_text("📥 Importing catalog...")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "catalog.jsonl.gz")
+        telegram_file = await reply.document.get_file()
+        await telegram_file.download_to_drive(path)
+        try:
+            users_added, notes_added = await database.run(catalog.import_file, path)
+        except (OSError, ValueError) as e:
+            logger.error(f"Catalog import failed: {e}")
+            await update.message.reply_text("❌ That file is not a valid catalog.")
+            return
+
+    await update.message.reply_text(f"✅ Imported {notes_added} notes and {users_added} users.")
+
 # --- Upload Flow ---
 
 async def start_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -256,30 +601,51 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     if message.document:
         file = message.document
         file_name = file.file_name
+        media_type = "document"
     elif message.photo:
         file = message.photo[-1]
         file_name = f"photo_{file.file_unique_id}.jpg"
+        media_type = "photo"
     else:
         await update.message.reply_text("Please send a valid document or image.")
         return UPLOAD_FILE
 
+    existing = await database.run(database.find_note_by_file, file.file_unique_id)
+    if existing:
+        note_id, title, subject = existing
+        keyboard = [[InlineKeyboardButton(f"📄 {title} ({subject})", callback_data=f"note_{note_id}")]]
+        await update.message.reply_text(
+            "This file has already been shared. Here is the existing note:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        context.user_data.clear()
+        return ConversationHandler.END
+
     context.user_data['upload_file_id'] = file.file_id
     context.user_data['upload_file_unique_id'] = file.file_unique_id
     context.user_data['upload_file_name'] = file_name
+    context.user_data['upload_media_type'] = media_type
 
     await update.message.reply_text(f"File received! Now, enter a title for this note.")
     return UPLOAD_TITLE
 
+async def _upload_expired(update: Update) -> int:
+    # The session's user_data was swept while the conversation was idle.
+    await update.message.reply_text(
+        "Your upload session expired. Use /upload to start again.",
+        reply_markup=ReplyKeyboardRemove()
+    )
+    return ConversationHandler.END
+
 async def handle_title(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle the title and ask for a subject."""
+    if 'upload_file_id' not in context.user_data:
+        return await _upload_expired(update)
     context.user_data['upload_title'] = update.message.text
     
-    reply_keyboard = [[sub] for sub in ALLOWED_SUBJECTS]
     await update.message.reply_text(
         "Great! Now, select the subject for this note from the options below:",
-        reply_markup=ReplyKeyboardMarkup(
-            reply_keyboard, one_time_keyboard=True, resize_keyboard=True
-        ),
+        reply_markup=UPLOAD_SUBJECT_MARKUP,
     )
     return UPLOAD_SUBJECT
 
@@ -293,18 +659,32 @@ async def handle_subject(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return UPLOAD_SUBJECT
 
+    if 'upload_title' not in context.user_data:
+        return await _upload_expired(update)
+
     user = update.effective_user
     
-    database.add_note(
+    note_id = await database.run(
+        database.add_note,
         file_id=context.user_data['upload_file_id'],
         file_unique_id=context.user_data['upload_file_unique_id'],
         file_name=context.user_data['upload_file_name'],
         title=context.user_data['upload_title'],
         subject=subject,
         user_id=user.id,
-        user_name=user.full_name
+        user_name=user.full_name,
+        # Sessions saved before media types were recorded lack it
+        media_type=context.user_data.get('upload_media_type'),
     )
 
+    if note_id is None:
+        await update.message.reply_text(
+            "This file has already been shared. Use /search or /browse to find it.",
+            reply_markup=ReplyKeyboardRemove()
+        )
+        context.user_data.clear()
+        return ConversationHandler.END
+
     # Random thank you messages
     messages = [
         f"✅ Successfully shared! I hope you will get an A for {subject}! 🌟",
@@ -328,94 +708,213 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data.clear()
     return ConversationHandler.END
 
+async def upload_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Forget an upload left unfinished for UPLOAD_SESSION_TTL seconds."""
+    context.user_data.clear()
+    await update.effective_message.reply_text(
+        "Upload cancelled after inactivity. Send /upload to start again.", reply_markup=ReplyKeyboardRemove()
+    )
+
 # --- Browse Flow ---
 
+@metrics.timed_handler
 async def browse_subjects(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show list of subjects."""
-    keyboard = [
-        [InlineKeyboardButton(subject, callback_data=f"sub_{subject}")]
-        for subject in ALLOWED_SUBJECTS
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Select a subject to browse:", reply_markup=reply_markup)
+    await update.message.reply_text("Select a subject to browse:", reply_markup=SUBJECTS_MARKUP)
+
+async def _show_subject_page(query, subject, cursor=None, backward=False) -> None:
+    """Edit the browse message to show one page of notes for a subject."""
+    # The version must be read before querying, as in database.get_notes_by_subject_page
+    key = (subject, database.subject_version(subject), cursor, backward)
+    reply_markup = page_markups.get(key)
+    if reply_markup is None:
+        notes, has_prev, has_next = await database.run(
+            database.get_notes_by_subject_page, subject, cursor, backward
+        )
+
+        if not notes:
+            if cursor is None:
+                await query.edit_message_text(f"No notes found for {subject}.")
+            else:
+                await query.edit_message_text(f"No more notes for {subject}.", reply_markup=BACK_MARKUP)
+            return
 
+        keyboard = [
+            [InlineKeyboardButton(f"📄 {note[1]} ({note[2]})", callback_data=f"note_{note[0]}")]
+            for note in notes
+        ]
+        nav_row = _page_nav_row("sp", notes, 4, has_prev, has_next, suffix=f"_{subject}")
+        if nav_row:
+            keyboard.append(nav_row)
+        keyboard.append([InlineKeyboardButton("🔥 Most downloaded", callback_data=f"top_{subject}")])
+        keyboard.append([BACK_BUTTON])
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        page_markups.set(key, reply_markup)
+
+    await query.edit_message_text(f"Notes for {subject}:", reply_markup=reply_markup)
+
+@metrics.timed_handler
 async def handle_subject_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show notes for the selected subject."""
     query = update.callback_query
     await query.answer()
-    
+
     subject = query.data.replace("sub_", "")
-    notes = database.get_notes_by_subject(subject)
-    
-    if not notes:
-        await query.edit_message_text(f"No notes found for {subject}.")
-        return
+    await _show_subject_page(query, subject)
 
-    keyboard = [
-        [InlineKeyboardButton(f"📄 {note[1]} ({note[2]})", callback_data=f"note_{note[0]}")]
-        for note in notes
-    ]
-    keyboard.append([InlineKeyboardButton("🔙 Back to Subjects", callback_data="back_to_subjects")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(f"Notes for {subject}:", reply_markup=reply_markup)
+@metrics.timed_handler
+async def handle_subject_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the next or previous page of notes for a subject."""
+    query = update.callback_query
+    await query.answer()
 
+    _, direction, note_id, upload_date, subject = query.data.split("_", 4)
+    await _show_subject_page(query, subject, (upload_date, int(note_id)), direction == "p")
+
+@metrics.timed_handler
 async def handle_note_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send the selected note to the user."""
     query = update.callback_query
     await query.answer()
     
     note_id = int(query.data.replace("note_", ""))
-    note = database.get_note_by_id(note_id)
+    note = await database.run(database.get_note_by_id, note_id)
     
     if not note:
         await query.edit_message_text("Sorry, note not found.")
         return
 
-    file_id, file_name, title, subject = note
-    
-    await query.message.reply_text(f"Sending '{title}' ({subject})...")
-    
+    file_id, file_name, title, subject, _, media_type = note
+    chat_id = query.message.chat_id
+    caption = f"Title: {title}\nSubject: {subject}"
+
+    async def send(kind):
+        if kind == "photo":
+            await context.bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption)
+        else:
+            await context.bot.send_document(chat_id=chat_id, document=file_id, filename=file_name, caption=caption)
+
     # Telegram handles file sending by file_id
     try:
-        await context.bot.send_document(
-            chat_id=query.message.chat_id,
-            document=file_id,
-            filename=file_name,
-            caption=f"Title: {title}\nSubject: {subject}"
-        )
+        if media_type:
+            await send(media_type)
+        else:
+            # Older notes don't record how they were uploaded: try a document,
+            # then a photo, and remember whichever works for next time
+            try:
+                await send("document")
+                media_type = "document"
+            except BadRequest:
+                await send("photo")
+                media_type = "photo"
+            await database.run(database.set_media_type, note_id, media_type)
+        await downloads.increment(note_id)
     except Exception as e:
-        logger.error(f"Error sending file: {e}")
-        # Try sending as photo if document fails (might have been uploaded as photo)
-        try:
-            await context.bot.send_photo(
-                chat_id=query.message.chat_id,
-                photo=file_id,
-                caption=f"Title: {title}\nSubject: {subject}"
-            )
-        except Exception as e2:
-            logger.error(f"Error sending photo: {e2}")
-            await query.message.reply_text("Could not send the file. It might have been deleted from Telegram servers.")
+        logger.error(f"Error sending note {note_id}: {e}")
+        await query.message.reply_text("Could not send the file. It might have been deleted from Telegram servers.")
+
+def _top_keyboard(notes):
+    return [
+        [InlineKeyboardButton(f"🔥 {title} ({subject}) · {count}", callback_data=f"note_{note_id}")]
+        for note_id, title, subject, count in notes
+    ]
+
+@metrics.timed_handler
+async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the most downloaded notes across all subjects."""
+    notes = await database.run(database.get_top_notes)
+    if not notes:
+        await update.message.reply_text("No notes have been downloaded yet. Use /browse to find some!")
+        return
+    await update.message.reply_text(
+        "🔥 Most downloaded notes:", reply_markup=InlineKeyboardMarkup(_top_keyboard(notes))
+    )
+
+async def handle_top_subject(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the most downloaded notes of a subject."""
+    query = update.callback_query
+    await query.answer()
+
+    subject = query.data.replace("top_", "", 1)
+    notes = await database.run(database.get_top_notes, subject)
+    if not notes:
+        await query.edit_message_text(f"No {subject} notes have been downloaded yet.", reply_markup=BACK_MARKUP)
+        return
+    keyboard = _top_keyboard(notes)
+    keyboard.append([BACK_BUTTON])
+    await query.edit_message_text(f"🔥 Most downloaded {subject} notes:", reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def handle_back_to_subjects(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Return to subject list."""
     query = update.callback_query
     await query.answer()
-    
-    keyboard = [
-        [InlineKeyboardButton(subject, callback_data=f"sub_{subject}")]
-        for subject in ALLOWED_SUBJECTS
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Select a subject to browse:", reply_markup=reply_markup)
 
-def main() -> None:
-    """Start the bot."""
-    if not TOKEN:
-        print("Error: TELEGRAM_BOT_TOKEN not found in .env file.")
-        return
+    await query.edit_message_text("Select a subject to browse:", reply_markup=SUBJECTS_MARKUP)
 
-    application = Application.builder().token(TOKEN).build()
+async def post_init(application: Application) -> None:
+    """Start background tasks once the application is initialized."""
+    user_writes.start()
+    downloads.start()
+    application.persistence.start_sweeper(application)
+
+async def post_shutdown(application: Application) -> None:
+    """Flush pending writes before the process exits."""
+    await user_writes.stop()
+    await downloads.stop()
+    await application.persistence.stop_sweeper()
+
+def _bot_api_request(pool_size: int) -> metrics.InstrumentedRequest:
+    """Build an HTTP client for Bot API calls from the BOT_API_* settings."""
+    http_version = "1.1"
+    if os.getenv("BOT_API_HTTP2", "0") == "1":
+        if importlib.util.find_spec("h2") is None:
+            logger.warning("BOT_API_HTTP2 needs the h2 package (pip install 'httpx[http2]'); using HTTP/1.1")
+        else:
+            http_version = "2"
+    return metrics.InstrumentedRequest(
+        connection_pool_size=pool_size,
+        http_version=http_version,
+        # Wait for a free connection during bursts rather than failing the call
+        pool_timeout=float(os.getenv("BOT_API_POOL_TIMEOUT", 5)),
+        # Keep idle connections well past httpx's 5s default, so traffic in
+        # bursts doesn't pay the TCP and TLS handshake again each time
+        httpx_kwargs={"limits": httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=float(os.getenv("BOT_API_KEEPALIVE", 60)),
+        )},
+    )
+
+def build_application(token: str, processes: int = 1) -> Application:
+    """Create the application with all handlers registered.
+
+    ``processes`` is the number of pre-fork workers sending in parallel;
+    each one gets an equal share of API_RATE_LIMIT.
+    """
+    pool_size = int(os.getenv("BOT_API_POOL_SIZE", 16))
+    session_ttl = int(os.getenv("UPLOAD_SESSION_TTL", 3600))
+    builder = (
+        Application.builder()
+        .token(token)
+        # Sends, edits and answers share one pool; long polling gets its own
+        # connection so a pending getUpdates never holds one of theirs
+        .request(_bot_api_request(pool_size))
+        .get_updates_request(_bot_api_request(1))
+        .persistence(persistence.SQLitePersistence(
+            update_interval=float(os.getenv("PERSISTENCE_INTERVAL", 10)),
+            session_ttl=session_ttl,
+        ))
+        .rate_limiter(ratelimit.ApiRateLimiter(
+            rate=float(os.getenv("API_RATE_LIMIT", 30)) / processes, max_in_flight=pool_size,
+        ))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    # A self-hosted Bot API server, or the fake one used by benchmarks/load_test.py
+    api_url = os.getenv("BOT_API_URL")
+    if api_url:
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+    application = builder.build()
 
     # Upload conversation handler
     upload_handler = ConversationHandler(
@@ -424,26 +923,54 @@ def main() -> None:
             UPLOAD_FILE: [MessageHandler(filters.Document.ALL | filters.PHOTO, handle_file)],
             UPLOAD_TITLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_title)],
             UPLOAD_SUBJECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_subject)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, upload_timeout)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="upload",
+        persistent=True,
+        # Ends abandoned uploads in memory; needs the job-queue extra
+        conversation_timeout=session_ttl,
     )
 
+    # Group -1 runs before every other handler
+    application.add_handler(TypeHandler(Update, throttle), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("about", about_command))
     application.add_handler(CommandHandler("browse", browse_subjects))
     application.add_handler(CommandHandler("search", search_command))
     application.add_handler(CommandHandler("my_notes", my_notes_command))
+    application.add_handler(CommandHandler("top", top_command))
     application.add_handler(CommandHandler("admin", admin_command))
     application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("broadcast_status", broadcast_status_command))
+    application.add_handler(CommandHandler("broadcast_resume", broadcast_resume_command))
     application.add_handler(CommandHandler("delete_note", admin_delete_note))
+    application.add_handler(CommandHandler("merge_duplicates", merge_duplicates_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("import", import_command))
     application.add_handler(upload_handler)
     
     # Callback queries for browsing and management
+    application.add_handler(InlineQueryHandler(inline_query))
     application.add_handler(CallbackQueryHandler(handle_subject_selection, pattern="^sub_"))
+    application.add_handler(CallbackQueryHandler(handle_subject_page, pattern="^sp_"))
     application.add_handler(CallbackQueryHandler(handle_note_selection, pattern="^note_"))
+    application.add_handler(CallbackQueryHandler(handle_top_subject, pattern="^top_"))
     application.add_handler(CallbackQueryHandler(handle_back_to_subjects, pattern="^back_to_subjects$"))
     application.add_handler(CallbackQueryHandler(handle_delete_callback, pattern="^del_"))
+    application.add_handler(CallbackQueryHandler(handle_my_notes_page, pattern="^mp_"))
+    return application
+
+def main() -> None:
+    """Start the bot."""
+    if not TOKEN:
+        print("Error: TELEGRAM_BOT_TOKEN not found in .env file.")
+        return
+
+    # Migrations must run before the application loads persisted upload
+    # sessions, which happens in initialize(), before post_init
+    database.init_db()
 
     # Run the bot
     print("Bot is starting...")
@@ -452,50 +979,42 @@ def main() -> None:
     webhook_url = os.getenv("WEBHOOK_URL")
     
     if webhook_url:
+        # Only the webhook server needs these (and Tornado); polling skips them
+        import prefork
+        import webhook
+
         port = int(os.environ.get("PORT", 8080))
         print(f"Starting Webhook on port {port}...")
         
-        # Define Tornado handlers
-        class HealthHandler(tornado.web.RequestHandler):
-            def get(self):
-                self.write("OK")
-                self.set_status(200)
-
-            def head(self):
-                self.set_status(200)
-
-        class WebhookHandler(tornado.web.RequestHandler):
-            async def post(self):
-                try:
-                    json_data = tornado.escape.json_decode(self.request.body)
-                    update = Update.de_json(json_data, application.bot)
-                    await application.process_update(update)
-                    self.write("OK")
-                except Exception as e:
-                    logger.error(f"Error in webhook: {e}")
-                    self.set_status(500)
-
-        async def run_server():
-            await application.initialize()
-            await application.start()
-            await application.bot.set_webhook(f"{webhook_url}/{TOKEN}")
-            
-            app = tornado.web.Application([
-                (r"/", HealthHandler),
-                (r"/" + TOKEN, WebhookHandler),
-            ])
-            app.listen(port)
-            print("Webhook Server Running...")
-            # Keep running
-            await asyncio.Event().wait()
-        
+        # Updates are acknowledged immediately and processed by a worker pool
+        # ("queue"), or processed before responding as before ("inline").
+        queued = os.getenv("WEBHOOK_MODE", "queue") != "inline"
+        secret = os.getenv("WEBHOOK_SECRET") or webhook.default_secret(TOKEN)
+        workers = int(os.getenv("WEBHOOK_WORKERS", 4))
+        queue_size = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+        processes = int(os.getenv("WEBHOOK_PROCESSES", 1))
+
+        if processes > 1:
+            page_markups.ttl = prefork.CACHE_TTL
+            prefork.run(
+                functools.partial(build_application, processes=processes), TOKEN, webhook_url, port, secret,
+                processes=processes, workers=workers, queue_size=queue_size,
+            )
+            return
+
         # Get existing loop or create new one to run the server
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(run_server())
+        loop.run_until_complete(webhook.serve(
+            build_application(TOKEN), TOKEN, webhook_url, port, secret,
+            queued=queued, workers=workers, queue_size=queue_size,
+        ))
 
     else:
         print("Starting Polling...")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        build_application(TOKEN).run_polling(allowed_updates=Update.ALL_TYPES)
+
+    # Pending writes were flushed by post_shutdown and the persistence
+    database.close_all()
 
 if __name__ == "__main__":
     # Fix for asyncio event loop issue in some environments/Python versions
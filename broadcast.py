@@ -0,0 +1,101 @@
+import asyncio
+import logging
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+import database
+from ratelimit import BULK, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+# The pace is set by the bot's ratelimit.ApiRateLimiter: sends are marked
+# BULK, so broadcasts get its bulk share of API_RATE_LIMIT.
+# Sends in flight at once; enough to keep the rate limit busy despite API latency.
+CONCURRENCY = 20
+# Recipients loaded from the database and checkpointed per batch.
+BATCH_SIZE = 200
+MAX_ATTEMPTS = 3
+
+# Jobs being sent by this process, keyed by job id.
+_running = {}
+
+
+def is_running(job_id):
+    return job_id in _running
+
+
+async def _send(bot, chat_id, text):
+    """Send one message, retrying flood-control and network errors."""
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML", rate_limit_args=BULK)
+            return database.RECIPIENT_SENT
+        except RetryAfter as e:
+            delay = retry_after_seconds(e)
+            logger.warning(f"Flood control hit while broadcasting, pausing for {delay}s")
+            # The rate limiter has paused every other sender as well
+            await asyncio.sleep(delay)
+        except (Forbidden, BadRequest) as e:
+            # Blocked the bot, deleted account, unknown chat: retrying won't help
+            logger.info(f"Broadcast to {chat_id} failed: {e}")
+            return database.RECIPIENT_FAILED
+        except NetworkError as e:
+            logger.warning(f"Network error broadcasting to {chat_id}: {e}")
+            await asyncio.sleep(2 ** attempt)
+    return database.RECIPIENT_FAILED
+
+
+async def run_job(bot, job_id, text, concurrency=CONCURRENCY, batch_size=BATCH_SIZE):
+    """Send ``text`` to every pending recipient of a job.
+
+    Recipients are streamed from the database in batches and each batch's
+    results are written back in one transaction, so an interrupted job can be
+    resumed and only re-sends messages whose result was never recorded.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def send_one(chat_id):
+        async with semaphore:
+            results.append((chat_id, await _send(bot, chat_id, text)))
+
+    after_user_id = 0
+    try:
+        while True:
+            batch = await database.run(database.get_pending_recipients, job_id, after_user_id, batch_size)
+            if not batch:
+                break
+            await asyncio.gather(*(send_one(chat_id) for chat_id in batch))
+            done, results[:] = results[:], []
+            await database.run(database.record_broadcast_results, job_id, done)
+            after_user_id = batch[-1]
+    finally:
+        if results:
+            # Interrupted mid-batch: keep what was already delivered
+            await database.run(database.record_broadcast_results, job_id, results)
+    await database.run(database.set_broadcast_status, job_id, "done")
+
+
+def start_job(bot, job_id, text, notify_chat_id=None):
+    """Run a job in the background and optionally report the result to a chat."""
+
+    async def runner():
+        try:
+            await run_job(bot, job_id, text)
+        except asyncio.CancelledError:
+            logger.info(f"Broadcast #{job_id} interrupted; it can be resumed")
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast #{job_id} failed: {e}")
+            return
+        finally:
+            _running.pop(job_id, None)
+        if notify_chat_id is not None:
+            job = await database.run(database.get_broadcast_job, job_id)
+            await bot.send_message(
+                chat_id=notify_chat_id,
+                text=f"✅ Broadcast #{job_id} complete. Sent to {job[4]}/{job[3]} users.",
+            )
+
+    _running[job_id] = asyncio.create_task(runner())
+    return _running[job_id]
@@ -0,0 +1,86 @@
+"""Gzipped JSON Lines export and import of the users and notes tables.
+
+The first line is a header naming the columns of each table; every other
+line is ``["users" | "notes", [values...]]``. Files are written and read
+one row at a time, so memory use does not depend on the catalog size.
+"""
+import gzip
+import json
+
+import database
+
+FORMAT = "asper21-catalog"
+VERSION = 1
+
+# Columns a row cannot be imported without
+REQUIRED = {
+    "users": ("user_id",),
+    "notes": ("file_id", "file_unique_id", "title", "subject", "user_id"),
+}
+
+
+def write_catalog(path):
+    """Write every user and note to ``path``; return ``(users, notes)`` counts."""
+    counts = {"users": 0, "notes": 0}
+    with gzip.open(path, "wt", encoding="utf-8", compresslevel=6) as f:
+        header = {
+            "format": FORMAT,
+            "version": VERSION,
+            "columns": {"users": database.USER_COLUMNS, "notes": database.NOTE_COLUMNS},
+        }
+        f.write(json.dumps(header) + "\n")
+        for table, rows in (("users", database.iter_users()), ("notes", database.iter_notes())):
+            for row in rows:
+                f.write(json.dumps([table, row], ensure_ascii=False) + "\n")
+                counts[table] += 1
+    return counts["users"], counts["notes"]
+
+
+def read_catalog(path):
+    """Yield ``(table, row)`` records from a catalog file, rows in database column order.
+
+    Raises ValueError if the file is not a catalog or a record is malformed:
+    it names a table other than users or notes, or lacks a REQUIRED value.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            header = json.loads(f.readline())
+        except (OSError, ValueError):
+            raise ValueError("Not a catalog file")
+        if not isinstance(header, dict) or header.get("format") != FORMAT:
+            raise ValueError("Not a catalog file")
+        columns = header.get("columns")
+        if not isinstance(columns, dict) or not all(isinstance(names, list) for names in columns.values()):
+            raise ValueError("Catalog header has no valid column list")
+        # Map the file's column order onto ours, so files stay importable if
+        # columns are added or reordered later.
+        expected = {"users": database.USER_COLUMNS, "notes": database.NOTE_COLUMNS}
+        positions, required = {}, {}
+        for table, names in expected.items():
+            index = {name: i for i, name in enumerate(columns.get(table, ()))}
+            positions[table] = [index.get(name) for name in names]
+            required[table] = [names.index(name) for name in REQUIRED[table]]
+        for number, line in enumerate(f, start=2):
+            try:
+                table, values = json.loads(line)
+                row = tuple(None if i is None else values[i] for i in positions[table])
+                valid = all(row[i] is not None for i in required[table])
+            except (KeyError, IndexError, TypeError, ValueError):
+                valid = False
+            if not valid:
+                raise ValueError(f"Invalid catalog record on line {number}")
+            yield table, row
+
+
+def import_file(path):
+    """Import a catalog file; return ``(users_added, notes_added)``.
+
+    The whole file is checked before anything is written, so a malformed
+    catalog raises ValueError without importing part of it.
+    """
+    try:
+        for _ in read_catalog(path):
+            pass
+    except EOFError:
+        raise ValueError("Catalog file is truncated")
+    return database.import_catalog(read_catalog(path))
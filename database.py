@@ -1,12 +1,131 @@
+import asyncio
+import functools
+import re
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import fuzzy
+import metrics
+from cache import TTLCache
 
 DB_NAME = "notes_bot.db"
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
+# Number of worker threads (and therefore long-lived connections) used to run
+# queries off the event loop.
+POOL_SIZE = 4
+
+# Notes shown per page in /browse and /my_notes.
+PAGE_SIZE = 10
+
+# Most downloaded notes remembered per subject in top_notes.
+TOP_NOTES = 10
+
+# Fuzzy search bounds: each query word is compared with at most
+# FUZZY_CANDIDATES indexed words sharing trigrams with it, and replaced by up
+# to FUZZY_EXPANSIONS of them scoring at least FUZZY_MIN_SCORE.
+FUZZY_CANDIDATES = 50
+FUZZY_EXPANSIONS = 5
+FUZZY_MIN_SCORE = 0.4
+
+# Longest pause between the transactions of a catalog import, in seconds.
+IMPORT_PAUSE = 0.05
+
+# Applied once to every pooled connection.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+)
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0
+_executor = None
+
+# Read-through caches for the hot browse queries. Subject listings are keyed
+# by a per-subject version that every write to that subject bumps, so stale
+# pages simply become unreachable and age out of the LRU.
+note_cache = TTLCache(maxsize=1024, ttl=300)
+subject_cache = TTLCache(maxsize=256, ttl=300)
+_subject_versions = {}
+# Writes from several pool threads bump the same counters
+_subject_versions_lock = threading.Lock()
+# Inline search results; any write to notes clears it.
+search_cache = TTLCache(maxsize=2048, ttl=300)
+
+
+def _connect():
+    # check_same_thread=False only so close_all() can close connections owned
+    # by the worker threads; each connection is still used by a single thread.
+    # The per-connection statement cache keeps the queries below prepared.
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, cached_statements=256)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_connection():
+    """Return the long-lived connection owned by the calling thread."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.generation != _generation:
+        conn = _connect()
+        _local.conn = conn
+        _local.generation = _generation
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="db")
+    return _executor
+
+
+async def run(func, *args, **kwargs):
+    """Run a blocking database function in the pool without blocking the event loop.
+
+    Example: ``notes = await database.run(database.get_notes_by_subject_page, subject)``
+    """
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+    if metrics.ENABLED:
+        call = functools.partial(_timed, func.__name__, call)
+    return await loop.run_in_executor(_get_executor(), call)
+
+
+def _timed(name, call):
+    # Runs in the pool thread, so queueing for a free connection isn't counted
+    start = time.perf_counter()
+    try:
+        return call()
+    finally:
+        metrics.DB_LATENCY.observe(name, time.perf_counter() - start)
+
+
+def close_all():
+    """Shut down the worker pool and close every pooled connection."""
+    global _executor, _generation
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+        _generation += 1
+
+
+def _migrate_base_tables(conn):
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS notes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             file_id TEXT NOT NULL,
@@ -19,116 +138,907 @@ def init_db():
             upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             full_name TEXT,
             joined_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    conn.commit()
-    conn.close()
-
-def add_user(user_id, full_name):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR IGNORE INTO users (user_id, full_name)
-        VALUES (?, ?)
-    ''', (user_id, full_name))
-    conn.commit()
-    conn.close()
-
-def get_all_users():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id FROM users')
-    users = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return users
-
-def get_stats():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM notes')
-    note_count = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(*) FROM users')
-    user_count = cursor.fetchone()[0]
-    conn.close()
-    return user_count, note_count
-
-def add_note(file_id, file_unique_id, file_name, title, subject, user_id, user_name):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO notes (file_id, file_unique_id, file_name, title, subject, user_id, user_name)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (file_id, file_unique_id, file_name, title, subject, user_id, user_name))
-    conn.commit()
-    conn.close()
+
+def _migrate_search_index(conn):
+    """Create the FTS5 index over notes and keep it in sync with triggers."""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'notes_fts'"
+    ).fetchone()
+    # External-content table: the index stores only tokens, the text stays in
+    # notes. Prefix indexes make 'term*' queries as cheap as exact matches.
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            title, subject, file_name,
+            content='notes', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts (rowid, title, subject, file_name)
+            VALUES (new.id, new.title, new.subject, new.file_name);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, title, subject, file_name)
+            VALUES ('delete', old.id, old.title, old.subject, old.file_name);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF title, subject, file_name ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, title, subject, file_name)
+            VALUES ('delete', old.id, old.title, old.subject, old.file_name);
+            INSERT INTO notes_fts (rowid, title, subject, file_name)
+            VALUES (new.id, new.title, new.subject, new.file_name);
+        END
+    ''')
+    if not exists:
+        # Backfill notes that were stored before the index existed.
+        conn.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+
+def _migrate_note_indexes(conn):
+    # id is the tie-breaker for notes uploaded within the same second, so the
+    # listing queries below are fully served by these indexes.
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notes_subject_date
+        ON notes (subject, upload_date DESC, id DESC)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notes_user_date
+        ON notes (user_id, upload_date DESC, id DESC)
+    ''')
+    duplicates = conn.execute('''
+        SELECT 1 FROM notes GROUP BY file_unique_id HAVING COUNT(*) > 1 LIMIT 1
+    ''').fetchone()
+    if duplicates:
+        # Older databases may already hold the same file twice; index it
+        # anyway and leave the uniqueness guarantee to new inserts.
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_notes_file_unique_id ON notes (file_unique_id)
+        ''')
+    else:
+        conn.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_notes_file_unique_id ON notes (file_unique_id)
+        ''')
+
+def _migrate_broadcasts(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_date TIMESTAMP
+        )
+    ''')
+    # status: 0 = pending, 1 = sent, 2 = failed
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+
+def _migrate_persistence(conn):
+    # Conversation states and user_data for persistence.SQLitePersistence,
+    # stored as JSON. updated_date lets abandoned sessions be swept.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_data_updated ON user_data (updated_date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations (updated_date)')
+
+def _migrate_downloads(conn):
+    conn.execute('ALTER TABLE notes ADD COLUMN downloads INTEGER NOT NULL DEFAULT 0')
+    # The TOP_NOTES most downloaded notes of each subject, kept up to date by
+    # record_downloads() so /top and the popular view never sort all notes.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS top_notes (
+            subject TEXT NOT NULL,
+            note_id INTEGER NOT NULL,
+            downloads INTEGER NOT NULL,
+            PRIMARY KEY (subject, note_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_top_notes_rank ON top_notes (subject, downloads DESC, note_id)')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_top_notes_note ON top_notes (note_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_notes_subject_downloads ON notes (subject, downloads DESC, id)')
+    # A deleted top note is replaced by the best note of its subject not yet
+    # in the table, so every subject keeps TOP_NOTES entries when it can.
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS top_notes_delete AFTER DELETE ON notes
+        WHEN EXISTS (SELECT 1 FROM top_notes WHERE note_id = old.id)
+        BEGIN
+            DELETE FROM top_notes WHERE note_id = old.id;
+            INSERT INTO top_notes (subject, note_id, downloads)
+            SELECT subject, id, downloads FROM notes
+            WHERE subject = old.subject AND downloads > 0
+              AND id NOT IN (SELECT note_id FROM top_notes WHERE subject = old.subject)
+            ORDER BY downloads DESC, id
+            LIMIT 1;
+        END
+    ''')
+
+def _migrate_trigrams(conn):
+    """Create the word trigram index used by search_notes_fuzzy and fill it."""
+    # Every distinct word of note titles and subjects, with the number of
+    # notes using it, so words can be dropped when their last note goes.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS search_words (
+            word TEXT PRIMARY KEY,
+            notes INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS word_trigrams (
+            trigram TEXT NOT NULL,
+            word TEXT NOT NULL,
+            PRIMARY KEY (trigram, word)
+        ) WITHOUT ROWID
+    ''')
+    _rebuild_search_words(conn)
+
+def _migrate_media_type(conn):
+    # How the file was uploaded, so it is sent back with the matching method
+    # in one call: 'document' or 'photo'. NULL for older notes until their
+    # first successful send records it (see set_media_type).
+    conn.execute('ALTER TABLE notes ADD COLUMN media_type TEXT')
+    # handle_file names photos after their file_unique_id, which no document shares
+    conn.execute('''
+        UPDATE notes SET media_type = 'photo'
+        WHERE file_name = 'photo_' || file_unique_id || '.jpg'
+    ''')
+
+def _migrate_stats(conn):
+    """Create the analytics counters behind get_stats and fill them."""
+    # Running totals: 'users', 'notes' and 'uploaders' (users with at least one note)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS subject_stats (
+            subject TEXT PRIMARY KEY,
+            notes INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_subject_stats_notes ON subject_stats (notes DESC, subject)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS uploader_stats (
+            user_id INTEGER PRIMARY KEY,
+            notes INTEGER NOT NULL
+        )
+    ''')
+    # Activity per UTC day, counting the notes that still exist
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            uploads INTEGER NOT NULL DEFAULT 0,
+            uploaders INTEGER NOT NULL DEFAULT 0,
+            new_users INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    # Who uploaded on which day, so daily_stats.uploaders counts each user once
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_uploaders (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_note_insert AFTER INSERT ON notes BEGIN
+            UPDATE stats_totals SET value = value + 1 WHERE name = 'notes';
+            INSERT INTO subject_stats (subject, notes) VALUES (new.subject, 1)
+            ON CONFLICT (subject) DO UPDATE SET notes = notes + 1;
+            UPDATE stats_totals SET value = value + 1 WHERE name = 'uploaders'
+              AND NOT EXISTS (SELECT 1 FROM uploader_stats WHERE user_id = new.user_id);
+            INSERT INTO uploader_stats (user_id, notes) VALUES (new.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET notes = notes + 1;
+            INSERT INTO daily_stats (day, uploads, uploaders)
+            SELECT date(new.upload_date), 1, NOT EXISTS (
+                SELECT 1 FROM daily_uploaders WHERE day = date(new.upload_date) AND user_id = new.user_id
+            )
+            WHERE new.upload_date IS NOT NULL
+            ON CONFLICT (day) DO UPDATE SET uploads = uploads + 1, uploaders = uploaders + excluded.uploaders;
+            INSERT OR IGNORE INTO daily_uploaders (day, user_id)
+            SELECT date(new.upload_date), new.user_id WHERE new.upload_date IS NOT NULL;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_note_delete AFTER DELETE ON notes BEGIN
+            UPDATE stats_totals SET value = value - 1 WHERE name = 'notes';
+            UPDATE subject_stats SET notes = notes - 1 WHERE subject = old.subject;
+            DELETE FROM subject_stats WHERE subject = old.subject AND notes <= 0;
+            UPDATE uploader_stats SET notes = notes - 1 WHERE user_id = old.user_id;
+            UPDATE stats_totals SET value = value - 1 WHERE name = 'uploaders'
+              AND EXISTS (SELECT 1 FROM uploader_stats WHERE user_id = old.user_id AND notes <= 0);
+            DELETE FROM uploader_stats WHERE user_id = old.user_id AND notes <= 0;
+            UPDATE daily_stats SET uploads = uploads - 1, uploaders = uploaders - NOT EXISTS (
+                SELECT 1 FROM notes WHERE user_id = old.user_id
+                  AND upload_date >= date(old.upload_date) AND upload_date < date(old.upload_date, '+1 day')
+            )
+            WHERE day = date(old.upload_date);
+            DELETE FROM daily_uploaders
+            WHERE day = date(old.upload_date) AND user_id = old.user_id AND NOT EXISTS (
+                SELECT 1 FROM notes WHERE user_id = old.user_id
+                  AND upload_date >= date(old.upload_date) AND upload_date < date(old.upload_date, '+1 day')
+            );
+            DELETE FROM daily_stats WHERE day = date(old.upload_date) AND uploads = 0 AND new_users = 0;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_note_subject AFTER UPDATE OF subject ON notes
+        WHEN old.subject IS NOT new.subject
+        BEGIN
+            UPDATE subject_stats SET notes = notes - 1 WHERE subject = old.subject;
+            DELETE FROM subject_stats WHERE subject = old.subject AND notes <= 0;
+            INSERT INTO subject_stats (subject, notes) VALUES (new.subject, 1)
+            ON CONFLICT (subject) DO UPDATE SET notes = notes + 1;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_user_insert AFTER INSERT ON users BEGIN
+            UPDATE stats_totals SET value = value + 1 WHERE name = 'users';
+            INSERT INTO daily_stats (day, new_users)
+            SELECT date(new.joined_date), 1 WHERE new.joined_date IS NOT NULL
+            ON CONFLICT (day) DO UPDATE SET new_users = new_users + 1;
+        END
+    ''')
+    _rebuild_stats(conn)
+
+# Schema history. PRAGMA user_version records how many of these have been
+# applied; only ever append new steps, never edit or reorder existing ones.
+MIGRATIONS = [
+    _migrate_base_tables,
+    _migrate_search_index,
+    _migrate_note_indexes,
+    _migrate_broadcasts,
+    _migrate_persistence,
+    _migrate_downloads,
+    _migrate_trigrams,
+    _migrate_media_type,
+    _migrate_stats,
+]
+
+def init_db():
+    """Bring the database schema up to date by applying pending migrations."""
+    conn = get_connection()
+    while True:
+        # BEGIN IMMEDIATE takes the write lock up front, so two processes
+        # starting together apply each migration exactly once.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.rollback()
+                break
+            MIGRATIONS[version](conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    conn.execute("PRAGMA optimize")
+
+def add_users(users):
+    """Register many ``(user_id, full_name)`` pairs in a single transaction."""
+    conn = get_connection()
+    with conn:
+        conn.executemany('''
+            INSERT OR IGNORE INTO users (user_id, full_name)
+            VALUES (?, ?)
+        ''', users)
+
+def _rebuild_stats(conn):
+    """Recompute every analytics counter from the users and notes tables."""
+    for table in ('stats_totals', 'subject_stats', 'uploader_stats', 'daily_stats', 'daily_uploaders'):
+        conn.execute(f'DELETE FROM {table}')
+    conn.execute('INSERT INTO subject_stats (subject, notes) SELECT subject, COUNT(*) FROM notes GROUP BY subject')
+    conn.execute('INSERT INTO uploader_stats (user_id, notes) SELECT user_id, COUNT(*) FROM notes GROUP BY user_id')
+    conn.execute('''
+        INSERT INTO stats_totals (name, value) VALUES
+            ('users', (SELECT COUNT(*) FROM users)),
+            ('notes', (SELECT COUNT(*) FROM notes)),
+            ('uploaders', (SELECT COUNT(*) FROM uploader_stats))
+    ''')
+    conn.execute('''
+        INSERT INTO daily_uploaders (day, user_id)
+        SELECT DISTINCT date(upload_date), user_id FROM notes WHERE upload_date IS NOT NULL
+    ''')
+    conn.execute('''
+        INSERT INTO daily_stats (day, uploads, uploaders, new_users)
+        SELECT day, SUM(uploads), SUM(uploaders), SUM(new_users) FROM (
+            SELECT date(upload_date) AS day, COUNT(*) AS uploads,
+                   COUNT(DISTINCT user_id) AS uploaders, 0 AS new_users
+            FROM notes WHERE upload_date IS NOT NULL GROUP BY day
+            UNION ALL
+            SELECT date(joined_date) AS day, 0, 0, COUNT(*)
+            FROM users WHERE joined_date IS NOT NULL GROUP BY day
+        )
+        GROUP BY day
+    ''')
+
+def get_stats(days=7, top_subjects=5):
+    """Return the admin dashboard figures from the counters kept by _migrate_stats.
+
+    The result has the ``users``, ``notes`` and ``uploaders`` totals,
+    ``days``: ``(day, uploads, uploaders, new_users)`` for each of the last
+    ``days`` UTC days, newest first, and ``subjects``: ``(subject, notes)``
+    for the ``top_subjects`` largest subjects. Nothing here scans notes or
+    users, so the cost does not grow with the catalog.
+    """
+    conn = get_connection()
+    stats = dict(conn.execute('SELECT name, value FROM stats_totals').fetchall())
+    today = datetime.now(timezone.utc).date()
+    first = (today - timedelta(days=days - 1)).isoformat()
+    daily = {
+        day: (uploads, uploaders, new_users)
+        for day, uploads, uploaders, new_users in conn.execute(
+            'SELECT day, uploads, uploaders, new_users FROM daily_stats WHERE day >= ?', (first,)
+        )
+    }
+    stats['days'] = []
+    for offset in range(days):
+        day = (today - timedelta(days=offset)).isoformat()
+        stats['days'].append((day, *daily.get(day, (0, 0, 0))))
+    stats['subjects'] = conn.execute(
+        'SELECT subject, notes FROM subject_stats ORDER BY notes DESC, subject LIMIT ?', (top_subjects,)
+    ).fetchall()
+    return stats
+
+def _invalidate_note(note_id, subject):
+    note_cache.pop(note_id)
+    search_cache.clear()
+    _bump_subject_version(subject)
+
+def _bump_subject_version(subject):
+    with _subject_versions_lock:
+        _subject_versions[subject] = _subject_versions.get(subject, 0) + 1
+
+def subject_version(subject):
+    """Return a counter that changes whenever a note in ``subject`` is added or removed."""
+    return _subject_versions.get(subject, 0)
+
+def cache_stats():
+    """Return ``{name: (hits, misses, size)}`` for the query caches."""
+    return {"notes": note_cache.stats(), "subjects": subject_cache.stats(), "search": search_cache.stats()}
+
+def add_note(file_id, file_unique_id, file_name, title, subject, user_id, user_name, media_type=None):
+    """Store a note and return its id, or None if this file is already shared."""
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO notes (file_id, file_unique_id, file_name, title, subject, user_id, user_name, media_type)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (file_id, file_unique_id, file_name, title, subject, user_id, user_name, media_type))
+        if cursor.rowcount > 0:
+            _index_words(conn, [(title, subject)])
+    if cursor.rowcount <= 0:
+        return None
+    _invalidate_note(cursor.lastrowid, subject)
+    return cursor.lastrowid
+
+def find_note_by_file(file_unique_id):
+    """Return ``(id, title, subject)`` of the note sharing this file, or None."""
+    conn = get_connection()
+    cursor = conn.execute('SELECT id, title, subject FROM notes WHERE file_unique_id = ? ORDER BY id LIMIT 1', (file_unique_id,))
+    return cursor.fetchone()
+
+def merge_duplicate_notes():
+    """Delete every note whose file was shared earlier, keeping the oldest copy.
+
+    Once no duplicates remain, the file_unique_id index is made unique if an
+    older database only had a plain one. Returns the number of notes removed.
+    """
+    conn = get_connection()
+    with conn:
+        # The copy that is kept inherits the downloads of the removed ones
+        conn.execute('''
+            UPDATE notes SET downloads = (
+                SELECT SUM(downloads) FROM notes AS copy WHERE copy.file_unique_id = notes.file_unique_id
+            )
+            WHERE id IN (SELECT MIN(id) FROM notes GROUP BY file_unique_id HAVING COUNT(*) > 1)
+        ''')
+        rows = conn.execute('''
+            DELETE FROM notes
+            WHERE id NOT IN (SELECT MIN(id) FROM notes GROUP BY file_unique_id)
+            RETURNING id, subject, title
+        ''').fetchall()
+        _unindex_words(conn, [(title, subject) for _, subject, title in rows])
+        unique = {name: is_unique for _, name, is_unique, *_ in conn.execute('PRAGMA index_list(notes)')}
+        if not unique.get('idx_notes_file_unique_id'):
+            conn.execute('DROP INDEX IF EXISTS idx_notes_file_unique_id')
+            conn.execute('CREATE UNIQUE INDEX idx_notes_file_unique_id ON notes (file_unique_id)')
+        if rows:
+            _rebuild_top_notes(conn)
+    for note_id, subject, _ in rows:
+        _invalidate_note(note_id, subject)
+    return len(rows)
 
 def get_subjects():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT DISTINCT subject FROM notes ORDER BY subject')
-    subjects = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return subjects
-
-def get_notes_by_subject(subject):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, title, file_name, user_name, upload_date FROM notes WHERE subject = ? ORDER BY upload_date DESC', (subject,))
-    notes = cursor.fetchall()
-    conn.close()
-    return notes
+    conn = get_connection()
+    cursor = conn.execute('SELECT DISTINCT subject FROM notes ORDER BY subject')
+    return [row[0] for row in cursor.fetchall()]
+
+def _notes_page(columns, where, params, cursor, backward, limit):
+    """Fetch one page of notes ordered newest first, using keyset pagination.
+
+    ``cursor`` is the ``(upload_date, id)`` of the row the page starts after
+    (or before, when ``backward`` is set), so every page is a bounded range
+    scan on the (…, upload_date DESC, id DESC) indexes no matter how deep it is.
+    Returns ``(rows, has_prev, has_next)``.
+    """
+    conn = get_connection()
+    if cursor is None:
+        sql = f'SELECT {columns} FROM notes WHERE {where} ORDER BY upload_date DESC, id DESC LIMIT ?'
+        args = (*params, limit + 1)
+    elif backward:
+        sql = f'SELECT {columns} FROM notes WHERE {where} AND (upload_date, id) > (?, ?) ORDER BY upload_date ASC, id ASC LIMIT ?'
+        args = (*params, *cursor, limit + 1)
+    else:
+        sql = f'SELECT {columns} FROM notes WHERE {where} AND (upload_date, id) < (?, ?) ORDER BY upload_date DESC, id DESC LIMIT ?'
+        args = (*params, *cursor, limit + 1)
+    rows = conn.execute(sql, args).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+        return rows, more, True
+    return rows, cursor is not None, more
+
+def get_notes_by_subject_page(subject, cursor=None, backward=False, limit=PAGE_SIZE):
+    # The version must be read before querying so a concurrent write can only
+    # ever leave a stale page under a key that is already outdated.
+    key = (subject, _subject_versions.get(subject, 0), cursor, backward, limit)
+    return subject_cache.get_or_load(
+        key,
+        lambda: _notes_page('id, title, file_name, user_name, upload_date', 'subject = ?', (subject,), cursor, backward, limit),
+    )
 
 def get_note_by_id(note_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT file_id, file_name, title, subject, user_id FROM notes WHERE id = ?', (note_id,))
-    note = cursor.fetchone()
-    conn.close()
-    return note
-
-def search_notes(query):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    # Search in title or subject
-    search_query = f"%{query}%"
-    cursor.execute('''
-        SELECT id, title, subject, file_name 
-        FROM notes 
-        WHERE title LIKE ? OR subject LIKE ? 
-        ORDER BY upload_date DESC 
-        LIMIT 10
-    ''', (search_query, search_query))
-    results = cursor.fetchall()
-    conn.close()
-    return results
-
-def get_user_notes(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, title, subject, upload_date FROM notes WHERE user_id = ? ORDER BY upload_date DESC', (user_id,))
-    notes = cursor.fetchall()
-    conn.close()
-    return notes
+    def load():
+        conn = get_connection()
+        cursor = conn.execute('SELECT file_id, file_name, title, subject, user_id, media_type FROM notes WHERE id = ?', (note_id,))
+        return cursor.fetchone()
+    return note_cache.get_or_load(note_id, load)
+
+def set_media_type(note_id, media_type):
+    """Record how a note without a known media type was successfully sent."""
+    conn = get_connection()
+    with conn:
+        conn.execute('UPDATE notes SET media_type = ? WHERE id = ? AND media_type IS NULL', (media_type, note_id))
+    note_cache.pop(note_id)
+    search_cache.clear()
+
+def _fts_query(query):
+    # Quote every word so user input can't inject FTS syntax, and make each one
+    # a prefix match: "photo cell" -> "photo"* "cell"* (all terms required).
+    terms = re.findall(r"\w+", query)
+    return " ".join(f'"{term}"*' for term in terms)
+
+def search_notes(query, limit=10):
+    match = _fts_query(query)
+    if not match:
+        return []
+    conn = get_connection()
+    # Ranked by bm25 with title matches weighted above subject and file name
+    cursor = conn.execute('''
+        SELECT notes.id, notes.title, notes.subject, notes.file_name
+        FROM notes_fts
+        JOIN notes ON notes.id = notes_fts.rowid
+        WHERE notes_fts MATCH ?
+        ORDER BY bm25(notes_fts, 10.0, 5.0, 1.0), notes.id DESC
+        LIMIT ?
+    ''', (match, limit))
+    return cursor.fetchall()
+
+def search_notes_inline(query, limit=20, offset=0):
+    """Return ``(id, file_id, file_name, title, subject, media_type)`` rows for inline mode.
+
+    Results are cached per normalized query and page, so repeated and
+    differently spelled variants of a query ("Cell ", "cell") share one lookup.
+    """
+    match = _fts_query(query).lower()
+    if not match:
+        return []
+
+    def load():
+        conn = get_connection()
+        cursor = conn.execute('''
+            SELECT notes.id, notes.file_id, notes.file_name, notes.title, notes.subject, notes.media_type
+            FROM notes_fts
+            JOIN notes ON notes.id = notes_fts.rowid
+            WHERE notes_fts MATCH ?
+            ORDER BY bm25(notes_fts, 10.0, 5.0, 1.0), notes.id DESC
+            LIMIT ? OFFSET ?
+        ''', (match, limit, offset))
+        return cursor.fetchall()
+    return search_cache.get_or_load((match, limit, offset), load)
+
+def _word_counts(notes):
+    counts = {}
+    for title, subject in notes:
+        for word in set(fuzzy.words(f"{title} {subject}")):
+            counts[word] = counts.get(word, 0) + 1
+    return counts
+
+def _index_words(conn, notes):
+    """Count the words of ``(title, subject)`` notes, indexing new words' trigrams."""
+    counts = _word_counts(notes)
+    conn.executemany('''
+        INSERT INTO search_words (word, notes) VALUES (?, ?)
+        ON CONFLICT (word) DO UPDATE SET notes = notes + excluded.notes
+    ''', counts.items())
+    conn.executemany(
+        'INSERT OR IGNORE INTO word_trigrams (trigram, word) VALUES (?, ?)',
+        ((gram, word) for word in counts for gram in fuzzy.word_trigrams(word)),
+    )
+
+def _unindex_words(conn, notes):
+    """Uncount the words of deleted ``(title, subject)`` notes, pruning unused ones."""
+    unused = []
+    for word, count in _word_counts(notes).items():
+        row = conn.execute('UPDATE search_words SET notes = notes - ? WHERE word = ? RETURNING notes',
+                           (count, word)).fetchone()
+        if row and row[0] <= 0:
+            unused.append(word)
+    conn.executemany('DELETE FROM search_words WHERE word = ?', ((word,) for word in unused))
+    conn.executemany('DELETE FROM word_trigrams WHERE trigram = ? AND word = ?',
+                     ((gram, word) for word in unused for gram in fuzzy.word_trigrams(word)))
+
+def _rebuild_search_words(conn, chunk_size=5000):
+    conn.execute('DELETE FROM search_words')
+    conn.execute('DELETE FROM word_trigrams')
+    cursor = conn.execute('SELECT title, subject FROM notes')
+    while rows := cursor.fetchmany(chunk_size):
+        _index_words(conn, rows)
+
+def _similar_words(conn, word):
+    grams = fuzzy.word_trigrams(word)
+    candidates = conn.execute(f'''
+        SELECT word FROM word_trigrams
+        WHERE trigram IN ({", ".join("?" * len(grams))})
+        GROUP BY word ORDER BY COUNT(*) DESC LIMIT ?
+    ''', (*grams, FUZZY_CANDIDATES)).fetchall()
+    scored = sorted(
+        ((fuzzy.similarity(word, candidate), candidate) for candidate, in candidates),
+        reverse=True,
+    )
+    return [candidate for score, candidate in scored[:FUZZY_EXPANSIONS] if score >= FUZZY_MIN_SCORE]
+
+def search_notes_fuzzy(query, limit=10):
+    """Return ``(id, title, subject, file_name)`` of notes resembling ``query``.
+
+    Tolerates typos and partial words ("chemstry", "photosynth"). Each query
+    word is corrected to the closest words that actually occur in titles
+    and subjects, found through their trigrams, and the corrected words are
+    then searched in the FTS index. The correction step only looks at the
+    vocabulary, so its cost does not grow with the number of notes.
+    """
+    conn = get_connection()
+    groups = []
+    for word in dict.fromkeys(fuzzy.words(query)):
+        similar = _similar_words(conn, word)
+        if similar:
+            groups.append("(" + " OR ".join(f'"{candidate}"' for candidate in similar) + ")")
+    if not groups:
+        return []
+    cursor = conn.execute('''
+        SELECT notes.id, notes.title, notes.subject, notes.file_name
+        FROM notes_fts
+        JOIN notes ON notes.id = notes_fts.rowid
+        WHERE notes_fts MATCH ?
+        ORDER BY bm25(notes_fts, 10.0, 5.0, 1.0), notes.id DESC
+        LIMIT ?
+    ''', (" AND ".join(groups), limit))
+    return cursor.fetchall()
+
+def get_user_notes_page(user_id, cursor=None, backward=False, limit=PAGE_SIZE):
+    return _notes_page('id, title, subject, upload_date', 'user_id = ?', (user_id,), cursor, backward, limit)
 
 def delete_note(note_id, user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM notes WHERE id = ? AND user_id = ?', (note_id, user_id))
-    rows_affected = cursor.rowcount
-    conn.commit()
-    conn.close()
-    return rows_affected > 0
+    conn = get_connection()
+    with conn:
+        row = conn.execute('DELETE FROM notes WHERE id = ? AND user_id = ? RETURNING subject, title', (note_id, user_id)).fetchone()
+        if row is not None:
+            _unindex_words(conn, [(row[1], row[0])])
+    if row is None:
+        return False
+    _invalidate_note(note_id, row[0])
+    return True
 
 def force_delete_note(note_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM notes WHERE id = ?', (note_id,))
-    rows_affected = cursor.rowcount
-    conn.commit()
-    conn.close()
-    return rows_affected > 0
+    conn = get_connection()
+    with conn:
+        row = conn.execute('DELETE FROM notes WHERE id = ? RETURNING subject, title', (note_id,)).fetchone()
+        if row is not None:
+            _unindex_words(conn, [(row[1], row[0])])
+    if row is None:
+        return False
+    _invalidate_note(note_id, row[0])
+    return True
+
+# --- Download counters ---
+
+def _rebuild_top_notes(conn):
+    conn.execute('DELETE FROM top_notes')
+    conn.execute('''
+        INSERT INTO top_notes (subject, note_id, downloads)
+        SELECT subject, id, downloads FROM (
+            SELECT subject, id, downloads,
+                   ROW_NUMBER() OVER (PARTITION BY subject ORDER BY downloads DESC, id) AS rank
+            FROM notes WHERE downloads > 0
+        )
+        WHERE rank <= ?
+    ''', (TOP_NOTES,))
+
+def record_downloads(rows):
+    """Add a batch of ``(note_id, count)`` download increments.
+
+    All counters are bumped by one UPDATE, then only the notes that changed
+    are merged into top_notes and their subjects trimmed back to TOP_NOTES.
+    Counts only grow, so a note outside the top list can only enter it by
+    being downloaded, which makes this incremental update exact.
+    """
+    conn = get_connection()
+    with conn:
+        for start in range(0, len(rows), 400):
+            batch = rows[start:start + 400]
+            values = ", ".join("(?, ?)" for _ in batch)
+            changed = conn.execute(f'''
+                UPDATE notes SET downloads = downloads + counts.column2
+                FROM (VALUES {values}) AS counts
+                WHERE notes.id = counts.column1
+                RETURNING notes.subject, notes.id, notes.downloads
+            ''', [value for row in batch for value in row]).fetchall()
+            conn.executemany('''
+                INSERT INTO top_notes (subject, note_id, downloads) VALUES (?, ?, ?)
+                ON CONFLICT (subject, note_id) DO UPDATE SET downloads = excluded.downloads
+            ''', changed)
+            conn.executemany('''
+                DELETE FROM top_notes WHERE subject = ?1 AND note_id NOT IN (
+                    SELECT note_id FROM top_notes WHERE subject = ?1
+                    ORDER BY downloads DESC, note_id LIMIT ?2
+                )
+            ''', [(subject, TOP_NOTES) for subject in {row[0] for row in changed}])
+
+def get_top_notes(subject=None, limit=TOP_NOTES):
+    """Return ``(id, title, subject, downloads)`` of the most downloaded notes.
+
+    Without ``subject`` the best notes across all subjects are returned; the
+    overall top ``limit`` is always contained in the per-subject lists.
+    """
+    conn = get_connection()
+    sql = '''
+        SELECT notes.id, notes.title, notes.subject, top_notes.downloads
+        FROM top_notes JOIN notes ON notes.id = top_notes.note_id
+        {where}
+        ORDER BY top_notes.downloads DESC, top_notes.note_id
+        LIMIT ?
+    '''
+    if subject is None:
+        return conn.execute(sql.format(where=''), (limit,)).fetchall()
+    return conn.execute(sql.format(where='WHERE top_notes.subject = ?'), (subject, limit)).fetchall()
+
+# --- Broadcast jobs ---
+
+RECIPIENT_PENDING, RECIPIENT_SENT, RECIPIENT_FAILED = range(3)
+
+def create_broadcast_job(message):
+    """Create a job with every current user as a pending recipient; return its id."""
+    conn = get_connection()
+    with conn:
+        job_id = conn.execute('INSERT INTO broadcast_jobs (message) VALUES (?)', (message,)).lastrowid
+        total = conn.execute('''
+            INSERT INTO broadcast_recipients (job_id, user_id)
+            SELECT ?, user_id FROM users
+        ''', (job_id,)).rowcount
+        conn.execute('UPDATE broadcast_jobs SET total = ? WHERE id = ?', (total, job_id))
+    return job_id
+
+def get_pending_recipients(job_id, after_user_id=0, limit=500):
+    """Return the next batch of pending recipients in user_id order."""
+    conn = get_connection()
+    cursor = conn.execute('''
+        SELECT user_id FROM broadcast_recipients
+        WHERE job_id = ? AND user_id > ? AND status = ?
+        ORDER BY user_id
+        LIMIT ?
+    ''', (job_id, after_user_id, RECIPIENT_PENDING, limit))
+    return [row[0] for row in cursor.fetchall()]
+
+def record_broadcast_results(job_id, results):
+    """Store a batch of ``(user_id, status)`` results and update the job counters."""
+    sent = sum(1 for _, status in results if status == RECIPIENT_SENT)
+    failed = len(results) - sent
+    conn = get_connection()
+    with conn:
+        conn.executemany(
+            'UPDATE broadcast_recipients SET status = ? WHERE job_id = ? AND user_id = ?',
+            [(status, job_id, user_id) for user_id, status in results],
+        )
+        conn.execute(
+            'UPDATE broadcast_jobs SET sent = sent + ?, failed = failed + ? WHERE id = ?',
+            (sent, failed, job_id),
+        )
+
+def set_broadcast_status(job_id, status):
+    conn = get_connection()
+    with conn:
+        conn.execute('''
+            UPDATE broadcast_jobs
+            SET status = ?, finished_date = CASE WHEN ? = 'done' THEN CURRENT_TIMESTAMP END
+            WHERE id = ?
+        ''', (status, status, job_id))
+
+def get_broadcast_job(job_id=None):
+    """Return ``(id, message, status, total, sent, failed, created_date, finished_date)``.
+
+    Without ``job_id`` the most recent job is returned.
+    """
+    conn = get_connection()
+    columns = 'id, message, status, total, sent, failed, created_date, finished_date'
+    if job_id is None:
+        cursor = conn.execute(f'SELECT {columns} FROM broadcast_jobs ORDER BY id DESC LIMIT 1')
+    else:
+        cursor = conn.execute(f'SELECT {columns} FROM broadcast_jobs WHERE id = ?', (job_id,))
+    return cursor.fetchone()
+
+# --- Conversation persistence ---
+
+def load_user_data():
+    """Return ``{user_id: data}`` with ``data`` still JSON-encoded."""
+    conn = get_connection()
+    return dict(conn.execute('SELECT user_id, data FROM user_data').fetchall())
+
+def save_user_data(rows):
+    """Apply a batch of ``(user_id, data)`` rows; ``data`` None deletes the row."""
+    conn = get_connection()
+    with conn:
+        conn.executemany('''
+            INSERT INTO user_data (user_id, data) VALUES (?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, updated_date = CURRENT_TIMESTAMP
+        ''', [row for row in rows if row[1] is not None])
+        conn.executemany(
+            'DELETE FROM user_data WHERE user_id = ?',
+            [(user_id,) for user_id, data in rows if data is None],
+        )
+
+def load_conversations(name):
+    """Return ``{key: state}`` for one ConversationHandler, both JSON-encoded."""
+    conn = get_connection()
+    cursor = conn.execute('SELECT key, state FROM conversations WHERE name = ?', (name,))
+    return dict(cursor.fetchall())
+
+def save_conversations(rows):
+    """Apply a batch of ``(name, key, state)`` rows; ``state`` None deletes the row."""
+    conn = get_connection()
+    with conn:
+        conn.executemany('''
+            INSERT INTO conversations (name, key, state) VALUES (?, ?, ?)
+            ON CONFLICT (name, key) DO UPDATE SET state = excluded.state, updated_date = CURRENT_TIMESTAMP
+        ''', [row for row in rows if row[2] is not None])
+        conn.executemany(
+            'DELETE FROM conversations WHERE name = ? AND key = ?',
+            [(name, key) for name, key, state in rows if state is None],
+        )
+
+def delete_stale_sessions(max_age):
+    """Delete conversations and user_data untouched for ``max_age`` seconds.
+
+    Returns the number of conversations deleted.
+    """
+    cutoff = f'-{int(max_age)} seconds'
+    conn = get_connection()
+    with conn:
+        deleted = conn.execute("DELETE FROM conversations WHERE updated_date < datetime('now', ?)", (cutoff,)).rowcount
+        conn.execute("DELETE FROM user_data WHERE updated_date < datetime('now', ?)", (cutoff,))
+    return deleted
+
+# --- Catalog import/export ---
+
+USER_COLUMNS = ('user_id', 'full_name', 'joined_date')
+NOTE_COLUMNS = ('file_id', 'file_unique_id', 'file_name', 'title', 'subject',
+                'user_id', 'user_name', 'upload_date', 'downloads', 'media_type')
+
+def iter_users(chunk_size=1000):
+    """Stream every user as a tuple of USER_COLUMNS."""
+    cursor = get_connection().execute(f'SELECT {", ".join(USER_COLUMNS)} FROM users ORDER BY user_id')
+    while rows := cursor.fetchmany(chunk_size):
+        yield from rows
+
+def iter_notes(chunk_size=1000):
+    """Stream every note as a tuple of NOTE_COLUMNS, oldest first."""
+    cursor = get_connection().execute(f'SELECT {", ".join(NOTE_COLUMNS)} FROM notes ORDER BY id')
+    while rows := cursor.fetchmany(chunk_size):
+        yield from rows
+
+def _import_chunk(conn, statement, table, chunk):
+    """Insert one chunk of an import in its own transaction; return the rows added."""
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        if table == 'users':
+            return conn.executemany(statement, chunk).rowcount
+        # Ids only grow and no other writer can run inside this transaction,
+        # so the notes past the old maximum are exactly the ones added here.
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM notes').fetchone()[0]
+        added = conn.executemany(statement, chunk).rowcount
+        _index_words(conn, conn.execute('SELECT title, subject FROM notes WHERE id > ?', (last_id,)).fetchall())
+        return added
+
+def import_catalog(records, chunk_size=1000):
+    """Bulk insert ``(table, row)`` records, ``table`` being 'users' or 'notes'.
+
+    Rows are tuples of USER_COLUMNS or NOTE_COLUMNS. Each chunk of
+    ``chunk_size`` rows is committed on its own, so uploads and session
+    saves from handlers only ever wait for one chunk, well within the busy
+    timeout, and memory stays flat however large the input. The search
+    index and the analytics counters are kept up to date row by row; the
+    top notes are recomputed once at the end. Users and files that already
+    exist are skipped, so an interrupted import can simply be run again.
+    Returns ``(users_added, notes_added)``.
+    """
+    statements = {
+        'users': f'INSERT OR IGNORE INTO users ({", ".join(USER_COLUMNS)}) VALUES ({", ".join("?" * len(USER_COLUMNS))})',
+        'notes': f'INSERT OR IGNORE INTO notes ({", ".join(NOTE_COLUMNS)}) VALUES ({", ".join("?" * len(NOTE_COLUMNS))})',
+    }
+    added = {'users': 0, 'notes': 0}
+    conn = get_connection()
+
+    def flush(table, chunk):
+        started = time.perf_counter()
+        added[table] += _import_chunk(conn, statements[table], table, chunk)
+        # Writers blocked on the lock retry with a growing backoff; a gap
+        # after each chunk lets them in long before their busy timeout.
+        time.sleep(min(time.perf_counter() - started, IMPORT_PAUSE))
+
+    chunk, table = [], None
+    for record_table, row in records:
+        if record_table != table or len(chunk) >= chunk_size:
+            if chunk:
+                flush(table, chunk)
+            chunk, table = [], record_table
+        chunk.append(row)
+    if chunk:
+        flush(table, chunk)
+
+    if added['notes']:
+        with conn:
+            _rebuild_top_notes(conn)
+        subjects = [row[0] for row in conn.execute('SELECT subject FROM subject_stats')]
+        note_cache.clear()
+        search_cache.clear()
+        for subject in subjects:
+            _bump_subject_version(subject)
+    conn.execute('PRAGMA optimize')
+    return added['users'], added['notes']
@@ -0,0 +1,22 @@
+"""Trigram helpers for typo-tolerant search.
+
+Words are lowercased and padded like PostgreSQL's pg_trgm ("  cell "), so
+"chemstry" still shares most of its trigrams with "chemistry" and short
+words get trigrams that mark where they start.
+"""
+import re
+
+
+def words(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def word_trigrams(word):
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(a, b):
+    """Trigram Jaccard similarity of two words, in [0, 1]."""
+    grams_a, grams_b = word_trigrams(a), word_trigrams(b)
+    return len(grams_a & grams_b) / len(grams_a | grams_b)
@@ -0,0 +1,139 @@
+"""Minimal in-process metrics exported in the Prometheus text format.
+
+Only what the bot needs: labelled counters and latency histograms, kept in
+plain dicts behind a lock. Everything is a no-op until ``ENABLED`` is set,
+so instrumented code pays one attribute lookup when metrics are off.
+"""
+import functools
+import threading
+import time
+
+from telegram.request import HTTPXRequest
+
+ENABLED = False
+
+# Upper bounds in seconds, from fast cache hits to slow Telegram uploads.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+class Counter:
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, label_value, amount=1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for value, count in sorted(self._values.items()):
+                lines.append(f'{self.name}{{{self.label}="{value}"}} {count}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, label, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        # label value -> [bucket counts..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, label_value, seconds):
+        with self._lock:
+            series = self._values.get(label_value)
+            if series is None:
+                series = self._values[label_value] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += seconds
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for value, series in sorted(self._values.items()):
+                label = f'{self.label}="{value}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series[-1]}')
+                lines.append(f"{self.name}_sum{{{label}}} {series[-2]:.6f}")
+                lines.append(f"{self.name}_count{{{label}}} {series[-1]}")
+        return lines
+
+
+HANDLER_LATENCY = Histogram("bot_handler_seconds", "Time spent in update handlers.", "handler")
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Update handlers that raised.", "handler")
+DB_LATENCY = Histogram("bot_db_query_seconds", "Time spent running database.py functions.", "function")
+API_LATENCY = Histogram("bot_api_request_seconds", "Latency of Telegram Bot API calls.", "method")
+API_ERRORS = Counter("bot_api_errors_total", "Telegram Bot API calls that failed.", "method")
+THROTTLED = Counter("bot_throttled_total", "Updates dropped by rate limiting.", "limit")
+
+
+def timed_handler(func):
+    """Record the latency and failures of an async handler under its name."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return await func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(name, time.perf_counter() - start)
+
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records latency and errors per Bot API method."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        if not ENABLED:
+            return await super().do_request(url, method, *args, **kwargs)
+        api_method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            API_ERRORS.inc(api_method)
+            raise
+        finally:
+            API_LATENCY.observe(api_method, time.perf_counter() - start)
+        if status >= 400:
+            API_ERRORS.inc(api_method)
+        return status, payload
+
+
+def render(extra=None):
+    """Return every metric in the Prometheus text format.
+
+    ``extra`` maps gauge names to numbers sampled at scrape time.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for name, value in (extra or {}).items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
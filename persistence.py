@@ -0,0 +1,136 @@
+"""SQLite-backed persistence for conversations and user_data.
+
+Keeps the upload ConversationHandler's state and the ``upload_*`` values in
+``user_data`` across restarts and deploys. Both are stored as JSON in the
+bot database (see ``database._migrate_persistence``).
+"""
+import asyncio
+import json
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import database
+from writebehind import WriteBehindQueue
+
+logger = logging.getLogger(__name__)
+
+
+class SQLitePersistence(BasePersistence):
+    """Persist conversations and user_data in SQLite.
+
+    Chat data, bot data and callback data are not used by the bot and are
+    not stored. The application already only hands over changed entries
+    every ``update_interval`` seconds; those are coalesced per key in
+    write-behind queues and written in one transaction per table. Sessions
+    untouched for ``session_ttl`` seconds are swept from the database every
+    ``sweep_interval`` seconds.
+    """
+
+    def __init__(self, update_interval=10, flush_interval=2.0, session_ttl=3600, sweep_interval=600):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.session_ttl = session_ttl
+        self.sweep_interval = sweep_interval
+        self._user_writes = WriteBehindQueue(database.save_user_data, interval=flush_interval)
+        self._conversation_writes = WriteBehindQueue(database.save_conversations, interval=flush_interval)
+        self._sweeper = None
+
+    async def get_user_data(self):
+        rows = await database.run(database.load_user_data)
+        return {user_id: json.loads(data) for user_id, data in rows.items()}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        rows = await database.run(database.load_conversations, name)
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows.items()}
+
+    async def update_conversation(self, name, key, new_state):
+        state = None if new_state is None else json.dumps(new_state)
+        self._conversation_writes.start()
+        await self._conversation_writes.put((name, key), (name, json.dumps(key), state))
+
+    async def update_user_data(self, user_id, data):
+        # An emptied user_data (upload finished or cancelled) is deleted
+        # rather than stored, so only in-progress sessions take up rows.
+        self._user_writes.start()
+        await self._user_writes.put(user_id, (user_id, json.dumps(data) if data else None))
+
+    async def drop_user_data(self, user_id):
+        self._user_writes.start()
+        await self._user_writes.put(user_id, (user_id, None))
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        await self._user_writes.stop()
+        await self._conversation_writes.stop()
+
+    async def sweep(self, application):
+        """Delete sessions abandoned for longer than ``session_ttl`` and empty user_data.
+
+        The upload ConversationHandler ends idle conversations itself (see
+        its conversation_timeout); this removes what that cannot reach.
+        """
+        # Rows may also belong to sessions another worker process abandoned,
+        # or that were abandoned before a restart and so have no timeout
+        await self._conversation_writes.flush()
+        deleted = await database.run(database.delete_stale_sessions, self.session_ttl)
+        # Users who never started an upload, or whose upload timed out, keep
+        # an empty user_data dict in memory; drop those so it doesn't grow
+        # with every user seen.
+        empty = [user_id for user_id, data in application.user_data.items() if not data]
+        for user_id in empty:
+            application.drop_user_data(user_id)
+        if deleted:
+            logger.info(f"Swept {deleted} abandoned upload sessions")
+
+    async def _run_sweeper(self, application):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep(application)
+            except Exception as e:
+                logger.error(f"Session sweep failed: {e}")
+
+    def start_sweeper(self, application):
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._run_sweeper(application))
+
+    async def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
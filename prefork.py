@@ -0,0 +1,140 @@
+"""Pre-fork multi-process webhook server.
+
+The master process owns the listening socket. It validates, decodes and
+de-duplicates each update, then hands it to one of ``processes`` worker
+processes, chosen by sender id. Every worker runs its own Application and
+UpdatePipeline, so handler work is spread across cores. Because a user's
+updates always reach the same worker, per-user in-memory state such as the
+upload ConversationHandler and ``user_data`` stays consistent without being
+shared between processes. All workers write to the same SQLite file, which
+runs in WAL mode with a busy timeout so concurrent writers wait rather than
+fail.
+"""
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+import webhook
+
+logger = logging.getLogger(__name__)
+
+# Seconds a worker may serve a cached note or subject listing that another
+# worker has since changed.
+CACHE_TTL = 10
+
+
+class ProcessDispatcher(webhook.UpdatePipeline):
+    """UpdatePipeline that forwards accepted updates to worker processes."""
+
+    def __init__(self, application, inboxes, dedupe_size=10000):
+        # No local queues: the worker inboxes take their place
+        super().__init__(application, workers=0, dedupe_size=dedupe_size)
+        self._queues = self._inboxes = inboxes
+
+    def _enqueue(self, sender_id, data):
+        try:
+            self._inboxes[sender_id % len(self._inboxes)].put_nowait(data)
+        except queue.Full:
+            return False
+        return True
+
+    def start(self):
+        self._callback_patterns = webhook.callback_patterns(self.application)
+
+    def queue_depth(self):
+        try:
+            return sum(inbox.qsize() for inbox in self._inboxes)
+        except NotImplementedError:
+            # Queue.qsize() is unavailable on macOS
+            return -1
+
+    def stats(self):
+        stats = super().stats()
+        stats["processes"] = stats.pop("workers")
+        # Processing happens in the workers; the master only forwards
+        for key in ("processed", "errors", "latency_avg_ms", "latency_max_ms"):
+            stats.pop(key)
+        return stats
+
+
+async def _run_worker(build_application, token, inbox, workers, queue_size):
+    application = build_application(token)
+    pipeline = webhook.UpdatePipeline(application, workers=workers, max_size=queue_size)
+    await webhook.start_application(application)
+    pipeline.start()
+
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="inbox") as reader:
+        try:
+            while True:
+                data = await loop.run_in_executor(reader, inbox.get)
+                if data is None:
+                    break
+                # Waits while the local queues are full, which in turn fills
+                # the inbox and makes the master answer 503.
+                await pipeline.put(data)
+        finally:
+            await pipeline.stop()
+            await webhook.stop_application(application)
+            database.close_all()
+
+
+def _worker_main(index, build_application, token, inbox, workers, queue_size):
+    # Shutdown signals often reach the whole process group. Workers leave
+    # them to the master, which stops them once their inboxes are drained.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger.info(f"Webhook worker {index} started")
+    asyncio.run(_run_worker(build_application, token, inbox, workers, queue_size))
+
+
+async def _run_master(build_application, token, webhook_url, port, secret, inboxes):
+    stop = webhook.shutdown_event()
+    dispatcher = ProcessDispatcher(build_application(token), inboxes)
+    dispatcher.start()
+    server = webhook.make_app(token, dispatcher, secret).listen(port)
+    # The application's bot, so its request settings and BOT_API_URL apply
+    async with dispatcher.application.bot as bot:
+        await webhook.ensure_webhook(bot, webhook_url, token, secret)
+    print("Webhook Server Running...")
+    # run() tells the workers to finish their inboxes and stop once this returns
+    await stop.wait()
+    server.stop()
+    await server.close_all_connections()
+
+
+def run(build_application, token, webhook_url, port, secret, processes, workers=4, queue_size=1000):
+    """Fork ``processes`` workers and serve the webhook from the master process."""
+    # Connections must never cross a fork: main() ran the migrations, so
+    # drop the master's connections before the workers are created.
+    database.close_all()
+    # Each worker caches queries in its own memory and only sees its own
+    # invalidations, so keep entries short-lived to bound cross-worker staleness.
+    database.note_cache.ttl = database.subject_cache.ttl = database.search_cache.ttl = CACHE_TTL
+
+    context = multiprocessing.get_context("fork")
+    inboxes = [context.Queue(maxsize=queue_size) for _ in range(processes)]
+    children = [
+        context.Process(
+            target=_worker_main,
+            args=(index, build_application, token, inbox, workers, queue_size),
+            name=f"webhook-worker-{index}",
+            daemon=True,
+        )
+        for index, inbox in enumerate(inboxes)
+    ]
+    for child in children:
+        child.start()
+    print(f"Started {processes} webhook worker processes")
+
+    try:
+        asyncio.run(_run_master(build_application, token, webhook_url, port, secret, inboxes))
+    finally:
+        for inbox in inboxes:
+            inbox.put(None)
+        for child in children:
+            child.join(timeout=30)
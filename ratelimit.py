@@ -0,0 +1,160 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+
+class TokenBucket:
+    """Async token bucket allowing ``rate`` acquisitions per second.
+
+    Up to ``capacity`` tokens can be spent in a burst. Waiters are served in
+    arrival order, and ``pause()`` blocks everyone for a while, which is how a
+    Telegram ``RetryAfter`` is honoured across all concurrent senders.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for ``seconds`` and drop any saved burst."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+        self._updated = self._blocked_until
+
+
+def retry_after_seconds(error):
+    """Return how long a ``RetryAfter`` error asks to wait, in seconds."""
+    retry_after = error.retry_after
+    # Newer python-telegram-bot versions report a timedelta instead of seconds
+    if hasattr(retry_after, "total_seconds"):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class UserRateLimiter:
+    """Per-user token buckets for flood protection, kept in a bounded LRU.
+
+    ``hit(key)`` spends a token and returns 0, or returns how many requests
+    in a row have been rejected, so callers can warn only on the first one.
+    Buckets are ordered by last use; one idle long enough to refill is the
+    same as no bucket, so it is evicted, and so is anything beyond
+    ``max_keys``. Memory therefore tracks recently active users only.
+    """
+
+    def __init__(self, rate, capacity, max_keys=100000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        # key -> [tokens, last update, consecutive rejections]
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def hit(self, key):
+        now = time.monotonic()
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            bucket = [self.capacity, now, 0]
+        else:
+            bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = 0
+        else:
+            bucket[2] += 1
+        self._buckets[key] = bucket
+        self._evict(now)
+        return bucket[2]
+
+    def _evict(self, now):
+        idle = self.capacity / self.rate
+        while self._buckets:
+            _, (_, updated, _) = next(iter(self._buckets.items()))
+            if now - updated < idle and len(self._buckets) <= self.max_keys:
+                break
+            self._buckets.popitem(last=False)
+
+
+# rate_limit_args marking bulk sends (broadcasts), which may only use part of
+# the global budget so interactive replies are never queued behind them.
+BULK = "bulk"
+
+
+class ApiRateLimiter(BaseRateLimiter):
+    """Global limiter for outgoing Bot API calls, used via ``builder.rate_limiter()``.
+
+    Calls that deliver or edit a message share one ``rate`` per second
+    bucket, matching Telegram's overall limit; other methods (answering
+    callback queries, getMe, ...) pass straight through. Bulk calls must
+    first get a token from a smaller bucket of ``bulk_rate``, two thirds of
+    ``rate`` unless given. A ``RetryAfter`` pauses every sender, and
+    interactive calls are retried up to ``max_retries`` times once the pause
+    is over, while bulk callers handle it themselves.
+
+    At most ``max_in_flight`` calls of any kind are handed to the HTTP client
+    at once. Set it to the connection pool size: httpx scans every queued
+    request against every connection whenever one frees up, so letting
+    calls pile up inside the pool costs more CPU than waiting here.
+    """
+
+    LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+
+    def __init__(self, rate=30, bulk_rate=None, max_retries=2, max_in_flight=None):
+        self.bucket = TokenBucket(rate)
+        self.bulk_bucket = TokenBucket(bulk_rate if bulk_rate is not None else rate * 2 / 3)
+        self.max_retries = max_retries
+        self._in_flight = asyncio.Semaphore(max_in_flight) if max_in_flight else None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        limited = endpoint.startswith(self.LIMITED_PREFIXES)
+        bulk = rate_limit_args == BULK
+        for attempt in range(self.max_retries + 1):
+            if limited:
+                if bulk:
+                    await self.bulk_bucket.acquire()
+                await self.bucket.acquire()
+            try:
+                if self._in_flight is None:
+                    return await callback(*args, **kwargs)
+                async with self._in_flight:
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                self.bucket.pause(delay)
+                if bulk or attempt == self.max_retries:
+                    raise
+                if not limited:
+                    # Only limited calls wait for the bucket before retrying
+                    await asyncio.sleep(delay)
@@ -0,0 +1,396 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import re
+import signal
+import time
+from collections import OrderedDict
+
+import tornado.web
+from telegram import Update
+from telegram.ext import CallbackQueryHandler, ConversationHandler
+
+import metrics
+
+# Decode webhook bodies with the fastest JSON library available. All of them
+# accept the raw request bytes, which skips decoding them to str first.
+try:
+    import orjson
+
+    loads = orjson.loads
+    JSONDecodeError = orjson.JSONDecodeError
+    JSON_BACKEND = "orjson"
+except ImportError:
+    try:
+        import msgspec
+
+        loads = msgspec.json.Decoder().decode
+        JSONDecodeError = msgspec.DecodeError
+        JSON_BACKEND = "msgspec"
+    except ImportError:
+        import json
+
+        loads = json.loads
+        JSONDecodeError = json.JSONDecodeError
+        JSON_BACKEND = "json"
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def default_secret(token):
+    """Derive a stable webhook secret from the bot token.
+
+    Telegram only allows ``A-Z a-z 0-9 _ -`` in secret tokens, so a hex
+    digest is used rather than the token itself.
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _sender_id(data):
+    # Every update type carries its payload in a single field; use the
+    # sender (or chat) id from it so one user's updates stay in order.
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("chat") or {}
+            return sender.get("id", 0)
+    return 0
+
+
+def _iter_handlers(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            yield from _iter_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                yield from _iter_handlers(state_handlers)
+            yield from _iter_handlers(handler.fallbacks)
+        else:
+            yield handler
+
+
+def callback_patterns(application):
+    """Return the regex patterns of every CallbackQueryHandler in the application.
+
+    Returns None if some CallbackQueryHandler accepts arbitrary data (no
+    pattern, or a callable/type pattern), in which case nothing can be
+    filtered up front.
+    """
+    patterns = []
+    for handlers in application.handlers.values():
+        for handler in _iter_handlers(handlers):
+            if isinstance(handler, CallbackQueryHandler):
+                if not isinstance(handler.pattern, re.Pattern):
+                    return None
+                patterns.append(handler.pattern)
+    return patterns
+
+
+class UpdatePipeline:
+    """Bounded queue of webhook updates processed by a pool of workers.
+
+    The HTTP handler only validates and enqueues, so Telegram gets its 200
+    immediately and slow handlers no longer hold webhook connections open.
+    Each worker owns one queue and updates are sharded by sender, which keeps
+    every user's updates (and their ConversationHandler state) strictly
+    ordered while different users are served concurrently. Recently seen
+    ``update_id`` values are remembered so Telegram redeliveries are dropped.
+    """
+
+    def __init__(self, application, workers=4, max_size=1000, dedupe_size=10000):
+        self.application = application
+        self._queues = [asyncio.Queue(maxsize=max(1, max_size // workers)) for _ in range(workers)]
+        self._tasks = []
+        self._seen = OrderedDict()
+        self._dedupe_size = dedupe_size
+        self.received = 0
+        self.processed = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.errors = 0
+        self.unroutable = 0
+        self._callback_patterns = None
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def is_duplicate(self, update_id):
+        return update_id is not None and update_id in self._seen
+
+    def _remember(self, update_id):
+        if update_id is None:
+            return
+        self._seen[update_id] = None
+        if len(self._seen) > self._dedupe_size:
+            self._seen.popitem(last=False)
+
+    def is_routable(self, data):
+        """Cheaply check, on the raw dict, whether any handler can take this update.
+
+        Callback queries whose data matches no CallbackQueryHandler pattern
+        would be ignored by the application anyway, so they are dropped
+        before paying for ``Update.de_json`` and handler dispatch.
+        """
+        query = data.get("callback_query")
+        if query is None or self._callback_patterns is None:
+            return True
+        callback_data = query.get("data")
+        if callback_data is None:
+            return True
+        if any(pattern.match(callback_data) for pattern in self._callback_patterns):
+            return True
+        self.unroutable += 1
+        return False
+
+    def submit(self, data):
+        """Enqueue a decoded update. Returns False if the queue is full."""
+        update_id = data.get("update_id")
+        if self.is_duplicate(update_id):
+            self.duplicates += 1
+            return True
+        if not self.is_routable(data):
+            return True
+        if not self._enqueue(_sender_id(data), data):
+            self.rejected += 1
+            return False
+        # Only remembered once accepted, so a rejected update can be redelivered
+        self._remember(update_id)
+        self.received += 1
+        return True
+
+    def _enqueue(self, sender_id, data):
+        queue = self._queues[sender_id % len(self._queues)]
+        try:
+            queue.put_nowait((time.monotonic(), data))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def put(self, data):
+        """Enqueue an already accepted update, waiting for room in its queue."""
+        queue = self._queues[_sender_id(data) % len(self._queues)]
+        await queue.put((time.monotonic(), data))
+        self.received += 1
+
+    async def process(self, data):
+        """Process one update inline, bypassing the queue."""
+        update = Update.de_json(data, self.application.bot)
+        await self.application.process_update(update)
+
+    async def process_once(self, data):
+        """Process an update inline unless it is a redelivery.
+
+        The id is only remembered once processing succeeded, so an update
+        that failed (and was answered with an error) is processed again when
+        Telegram redelivers it.
+        """
+        update_id = data.get("update_id")
+        if self.is_duplicate(update_id):
+            self.duplicates += 1
+            return
+        if self.is_routable(data):
+            await self.process(data)
+        self._remember(update_id)
+
+    async def _worker(self, queue):
+        while True:
+            enqueued, data = await queue.get()
+            try:
+                await self.process(data)
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Error processing update {data.get('update_id')}: {e}")
+            finally:
+                latency = time.monotonic() - enqueued
+                self.processed += 1
+                self._latency_total += latency
+                self._latency_max = max(self._latency_max, latency)
+                queue.task_done()
+
+    def start(self):
+        # Handlers are registered by now, so their patterns can be collected
+        self._callback_patterns = callback_patterns(self.application)
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    async def stop(self):
+        """Finish every queued update, then stop the workers."""
+        for queue in self._queues:
+            await queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def queue_depth(self):
+        return sum(queue.qsize() for queue in self._queues)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "workers": len(self._queues),
+            "received": self.received,
+            "processed": self.processed,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "unroutable": self.unroutable,
+            "latency_avg_ms": round(self._latency_total / self.processed * 1000, 2) if self.processed else 0.0,
+            "latency_max_ms": round(self._latency_max * 1000, 2),
+        }
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("OK")
+        self.set_status(200)
+
+    def head(self):
+        self.set_status(200)
+
+
+class StatusHandler(tornado.web.RequestHandler):
+    def initialize(self, pipeline):
+        self.pipeline = pipeline
+
+    def get(self):
+        self.write(self.pipeline.stats())
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, pipeline):
+        self.pipeline = pipeline
+
+    def get(self):
+        gauges = {
+            f"bot_webhook_{key}": value
+            for key, value in self.pipeline.stats().items()
+        }
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render(gauges))
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, pipeline, secret, queued):
+        self.pipeline = pipeline
+        self.secret = secret
+        self.queued = queued
+
+    async def post(self):
+        received = self.request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(received.encode(), self.secret.encode()):
+            self.set_status(403)
+            return
+
+        try:
+            data = loads(self.request.body)
+        except (ValueError, JSONDecodeError) as e:
+            logger.error(f"Invalid webhook payload: {e}")
+            self.set_status(400)
+            return
+        if not isinstance(data, dict):
+            self.set_status(400)
+            return
+
+        if self.queued:
+            if not self.pipeline.submit(data):
+                # Telegram retries later; this is our backpressure
+                self.set_status(503)
+                return
+        else:
+            try:
+                await self.pipeline.process_once(data)
+            except Exception as e:
+                logger.error(f"Error in webhook: {e}")
+                self.set_status(500)
+                return
+        self.write("OK")
+
+
+async def start_application(application):
+    """Initialize and start an application, running its post_init hook.
+
+    PTB only calls post_init/post_shutdown from run_polling/run_webhook, so
+    custom servers have to do it themselves.
+    """
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+
+async def stop_application(application):
+    await application.stop()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+    await application.shutdown()
+
+
+def shutdown_event():
+    """Return an event that is set when the process receives SIGTERM or SIGINT."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows: Ctrl+C still raises KeyboardInterrupt
+            pass
+    return stop
+
+
+async def ensure_webhook(bot, webhook_url, token, secret):
+    """Point Telegram at this server unless it already is; return True if it was set.
+
+    Telegram never reveals the secret of a registered webhook, so a short
+    hash of it goes into the URL's query string (which routing ignores);
+    a changed secret then changes the URL and is registered again.
+    """
+    fingerprint = hashlib.sha256(secret.encode()).hexdigest()[:12]
+    url = f"{webhook_url}/{token}?v={fingerprint}"
+    info = await bot.get_webhook_info()
+    if info.url == url:
+        return False
+    await bot.set_webhook(url, secret_token=secret)
+    return True
+
+
+async def serve(application, token, webhook_url, port, secret, queued=True, workers=4, queue_size=1000):
+    """Run the webhook server for one application in this process until SIGTERM or SIGINT.
+
+    On shutdown, queued updates are processed and the application is shut
+    down (flushing its pending writes) before this returns.
+    """
+    started = time.perf_counter()
+    stop = shutdown_event()
+    pipeline = UpdatePipeline(application, workers=workers, max_size=queue_size)
+    await start_application(application)
+    pipeline.start()
+    # Listen before registering, so the first deliveries find the server up
+    server = make_app(token, pipeline, secret, queued=queued).listen(port)
+    registered = await ensure_webhook(application.bot, webhook_url, token, secret)
+    logger.info(
+        f"Webhook server ready in {time.perf_counter() - started:.2f}s"
+        + ("" if registered else " (webhook already registered)")
+    )
+    print("Webhook Server Running...")
+    try:
+        await stop.wait()
+        logger.info(f"Shutting down, {pipeline.queue_depth()} queued updates left to process")
+    finally:
+        # Stop accepting updates, let in-flight requests finish, then
+        # process everything already queued
+        server.stop()
+        await server.close_all_connections()
+        await pipeline.stop()
+        await stop_application(application)
+
+
+def make_app(token, pipeline, secret, queued=True):
+    """Build the Tornado application serving the webhook, health, status and metrics routes."""
+    return tornado.web.Application([
+        (r"/", HealthHandler),
+        (r"/status", StatusHandler, {"pipeline": pipeline}),
+        (r"/metrics", MetricsHandler, {"pipeline": pipeline}),
+        (r"/" + token, WebhookHandler, {"pipeline": pipeline, "secret": secret, "queued": queued}),
+    ])
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+
+import database
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """Coalesce frequent writes in memory and apply them in periodic batches.
+
+    ``put(key, row)`` keeps one row per key (the latest, unless ``merge`` is
+    overridden), and every ``interval`` seconds the pending rows are handed
+    to ``flush_func`` (a blocking function from database.py taking a list of
+    rows) in one call, so a burst of identical writes costs one transaction
+    instead of one each.
+    Once ``max_pending`` rows are waiting, ``put`` flushes before returning,
+    which bounds memory and pushes back on callers.
+    """
+
+    def __init__(self, flush_func, interval=2.0, max_pending=5000):
+        self.flush_func = flush_func
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def merge(self, old, new):
+        """Combine two rows for the same key; the newer one wins by default."""
+        return new
+
+    async def put(self, key, row):
+        old = self._pending.get(key)
+        self._pending[key] = row if old is None else self.merge(old, row)
+        if len(self._pending) >= self.max_pending:
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            rows, self._pending = self._pending, {}
+            try:
+                await database.run(self.flush_func, list(rows.values()))
+            except Exception as e:
+                logger.error(f"Write-behind flush of {len(rows)} rows failed: {e}")
+                # Keep the rows for the next attempt, merged under any newer ones
+                for key, row in rows.items():
+                    newer = self._pending.get(key)
+                    self._pending[key] = row if newer is None else self.merge(row, newer)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the periodic flush and write out everything still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+class CounterQueue(WriteBehindQueue):
+    """Write-behind queue of ``(key, count)`` rows that sums increments per key."""
+
+    def merge(self, old, new):
+        return (old[0], old[1] + new[1])
+
+    async def increment(self, key, amount=1):
+        await self.put(key, (key, amount))